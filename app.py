@@ -1,15 +1,29 @@
 import os
 import re
-import json
+import asyncio
 import time
 import base64
-import tempfile
-import subprocess
-from typing import Optional, Dict, Any, List, Tuple
-
-import requests
+import io
+import hashlib
+import hmac
+import functools
+import sys
+import weakref
+from types import MappingProxyType
+from typing import Optional, Dict, Any, Callable, List, Mapping, Tuple
+
+import httpx
+import orjson
+from cachetools import TTLCache
+import redis.asyncio as aioredis
 from fastapi import FastAPI, Request
-from openai import OpenAI
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from openai import AsyncOpenAI
+
+try:
+    import av  # PyAV: in-process libav transcoding, no ffmpeg fork per voice
+except ImportError:
+    av = None
 
 # ===================== ENV =====================
 TELEGRAM_BOT_TOKEN = os.environ["TELEGRAM_BOT_TOKEN"]
@@ -18,6 +32,7 @@ OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
 GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")
 GITHUB_REPO = os.environ.get("GITHUB_REPO")  # "owner/repo" (fallback for single-repo mode)
 GITHUB_LABELS = os.environ.get("GITHUB_LABELS", "")
+_LABELS = tuple(x.strip() for x in GITHUB_LABELS.split(",") if x.strip())
 
 # Multi-repo config
 # GITHUB_REPOS="owner/repo1:short1:default_branch1,owner/repo2:short2:default_branch2"
@@ -30,6 +45,12 @@ _NETLIFY_SITE_MAP_RAW = os.environ.get("NETLIFY_SITE_MAP", "")
 # In groups: require /ticket to avoid noise (recommended)
 REQUIRE_TICKET_COMMAND = os.environ.get("REQUIRE_TICKET_COMMAND", "true").lower() in ("1", "true", "yes", "y")
 ARM_TTL_SECONDS = int(os.environ.get("ARM_TTL_SECONDS", "120"))  # /ticket -> wait next voice within TTL
+MAX_AUDIO_BYTES = 20 * 1024 * 1024  # Bot API getFile can't serve larger files anyway
+UPDATE_TIMEOUT_SECONDS = int(os.environ.get("UPDATE_TIMEOUT_SECONDS", "120"))  # wall-clock budget per update
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "32"))  # updates processed at once
+# Shared with the CI workflow: X-Bot-Secret = hex HMAC-SHA256 of the request body (checks off when unset)
+NOTIFY_SECRET = os.environ.get("NOTIFY_SECRET", "").encode()
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", "1.0"))  # log HTTP requests slower than this
 
 # WebApp URLs (Netlify)
 def _ensure_https(url: str) -> str:
@@ -67,13 +88,14 @@ def _parse_developer_map(raw: str) -> Dict[int, Dict[str, str]]:
         except ValueError:
             print(f"[WARN] Invalid tg_id in DEVELOPER_MAP: {parts[0]!r}")
             continue
-        result[tg_id] = {"branch": parts[1], "label": parts[2]}
+        result[tg_id] = {"branch": sys.intern(parts[1]), "label": sys.intern(parts[2])}
     return result
 
-DEVELOPER_MAP: Dict[int, Dict[str, str]] = _parse_developer_map(_DEV_MAP_RAW)
+# Read-only after startup; inner dicts stay plain dicts (they are copied into drafts and JSON-serialized)
+DEVELOPER_MAP: Mapping[int, Dict[str, str]] = MappingProxyType(_parse_developer_map(_DEV_MAP_RAW))
 
 # Reverse lookup: branch → user_id (for DEV_CHAT fallback after bot restart)
-_BRANCH_TO_DEV: Dict[str, int] = {info["branch"]: uid for uid, info in DEVELOPER_MAP.items()}
+_BRANCH_TO_DEV: Mapping[str, int] = MappingProxyType({info["branch"]: uid for uid, info in DEVELOPER_MAP.items()})
 
 # ===================== MULTI-REPO CONFIG =====================
 def _parse_repos(raw: str) -> Dict[str, Dict[str, str]]:
@@ -172,19 +194,22 @@ if not REPO_CONFIG and GITHUB_REPO:
 _PERSIST_DIR = os.environ.get("PERSIST_DIR", os.path.dirname(__file__))
 _USER_REPO_FILE = os.path.join(_PERSIST_DIR, ".user_active_repo.json")
 
+# Shared state backend (drafts). Set REDIS_URL to share state across workers and survive restarts.
+REDIS_URL = os.environ.get("REDIS_URL", "")
+
 def _load_user_active_repo() -> Dict[int, str]:
     try:
-        with open(_USER_REPO_FILE, "r") as f:
-            data = json.load(f)
+        with open(_USER_REPO_FILE, "rb") as f:
+            data = orjson.loads(f.read())
             # JSON keys are strings, convert back to int
             return {int(k): v for k, v in data.items() if v in REPO_CONFIG}
-    except (FileNotFoundError, json.JSONDecodeError, ValueError):
+    except (FileNotFoundError, ValueError):
         return {}
 
 def _save_user_active_repo():
     try:
-        with open(_USER_REPO_FILE, "w") as f:
-            json.dump({str(k): v for k, v in USER_ACTIVE_REPO.items()}, f)
+        with open(_USER_REPO_FILE, "wb") as f:
+            f.write(orjson.dumps({str(k): v for k, v in USER_ACTIVE_REPO.items()}))
     except OSError as e:
         print(f"[WARN] Failed to save USER_ACTIVE_REPO: {e}")
 
@@ -230,29 +255,31 @@ BOT_STARTED_AT = int(time.time())
 BUILD_ID = os.environ.get("BUILD_ID", os.environ.get("RAILWAY_DEPLOYMENT_ID", os.environ.get("RENDER_GIT_COMMIT", "local")))
 
 # Notifications state
+# Per-branch maps are TTL-bounded: branches come and go, entries must not pile up forever.
 # Maps branch → {chat_id, user_id, first_name} (запоминаем откуда и кто создавал тикеты)
-DEV_CHAT: Dict[str, Dict[str, Any]] = {}  # e.g. {"dev/Gleb": {"chat_id": -100123, "user_id": 456, "first_name": "Глеб"}}
+DEV_CHAT_TTL_SECONDS = 30 * 86400
+DEV_CHAT: TTLCache = TTLCache(maxsize=1024, ttl=DEV_CHAT_TTL_SECONDS)  # e.g. {"dev/Gleb": {"chat_id": -100123, "user_id": 456, "first_name": "Глеб"}}
 
 # Track recently created branches to distinguish "created from main" deploys
-BRANCH_JUST_CREATED: Dict[str, float] = {}  # branch → timestamp
+BRANCH_JUST_CREATED: TTLCache = TTLCache(maxsize=1024, ttl=86400)  # branch → timestamp
 
 # Ticket queue: persisted as GitHub Issues with queue:pending / queue:execute labels
 # TICKET_QUEUE dict removed — queue lives in GitHub Issues now
 
-# Currently executing ticket: branch → issue info (None if idle)
+# Currently executing ticket: branch → issue info (absent if idle)
 # Recovered from GitHub Issues (queue:execute label) on bot restart
-ACTIVE_TICKET: Dict[str, Optional[Dict[str, Any]]] = {}  # {"issue_number": int, "title": str}
+ACTIVE_TICKET: Dict[str, Dict[str, Any]] = {}  # {"issue_number": int, "title": str}
 
 # Last Netlify deploy URL per branch (saved when CI is active, included in final notification)
-LAST_DEPLOY_URL: Dict[str, str] = {}  # branch → ssl_url
+LAST_DEPLOY_URL: TTLCache = TTLCache(maxsize=512, ttl=7 * 86400)  # branch → ssl_url
 
 # Recently merged branches — catch Netlify deploy that arrives after CI finishes
 # branch → {"chat_id": int, "message_id": int, "text": str, "ts": float}
-RECENTLY_MERGED: Dict[str, Dict[str, Any]] = {}
+RECENTLY_MERGED: TTLCache = TTLCache(maxsize=512, ttl=3600)
 
 # Grace period after task completion — suppress standalone deploy notifications
 # ctx → timestamp (set when "merged" fires, any deploy within 90s is silently ignored)
-RECENTLY_COMPLETED: Dict[str, float] = {}
+RECENTLY_COMPLETED: TTLCache = TTLCache(maxsize=512, ttl=3600)
 
 # CI progress tracking per branch (for /status command)
 # {"started_at": int, "last_phase": str, "last_message": str, "last_update_at": int}
@@ -262,27 +289,183 @@ CI_PROGRESS: Dict[str, Dict[str, Any]] = {}
 # Status dict: {"status": "pending"|"approved"|"rejected"|"revision", "feedback": str|None}
 APPROVAL_REQUESTS: Dict[str, Any] = {}
 
+# Reverse index for approval buttons: issue_number → approval_key of its pending request
+APPROVAL_BY_ISSUE: Dict[str, str] = {}
+
 # Track which chat is awaiting feedback text for plan revision
-# chat_id → {"approval_key": str, "issue_number": str}
-APPROVAL_AWAITING_FEEDBACK: Dict[int, Dict[str, str]] = {}
+# chat_id → {"approval_key": str, "issue_number": str}; abandoned prompts expire after 30 min
+APPROVAL_AWAITING_FEEDBACK: TTLCache = TTLCache(maxsize=1024, ttl=1800)
 
-# Default ticket options
-DEFAULT_OPTIONS = {"multi_agent": False, "testing": False, "approve_plan": False}
+# Default ticket options (read-only). Drafts carry no "options" until the first toggle
+# copies them (copy-on-write); readers use state.get("options", DEFAULT_OPTIONS).
+DEFAULT_OPTIONS = MappingProxyType({"multi_agent": False, "testing": False, "approve_plan": False})
 
 # Labels for ticket options
-OPTION_LABELS = {
+OPTION_LABELS = MappingProxyType({
     "multi_agent": "ci:multi-agent",
     "testing": "ci:testing",
     "approve_plan": "ci:approve",
-}
+})
+
+# Confirmation keyboard callback action → option key
+_OPTION_TOGGLES = {"opt_ma": "multi_agent", "opt_test": "testing", "opt_appr": "approve_plan"}
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+# SDK default timeout is 10 minutes. Both attempts (timeout × (1 + max_retries)) fit in half of
+# UPDATE_TIMEOUT_SECONDS, so a stuck transcription raises its own error before the update is cut off.
+OPENAI_TIMEOUT_SECONDS = max(10, UPDATE_TIMEOUT_SECONDS // 4)
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT_SECONDS, max_retries=1)
 
 TG_API = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
 TG_FILE_API = f"https://api.telegram.org/file/bot{TELEGRAM_BOT_TOKEN}"
 GH_API = "https://api.github.com"
 
-app = FastAPI()
+
+# Telegram: shared async HTTP/2 clients, so concurrent updates don't block the event loop
+# and every call reuses a keep-alive connection. File downloads get their own pool
+# so long streams don't hold connections needed by small API calls.
+# Payloads are pre-serialized with orjson (UTF-8 Cyrillic, no \uXXXX escapes).
+# Granular timeouts (python-telegram-bot style): fail fast on connect/pool, leave room for reads.
+TG_TIMEOUT = httpx.Timeout(connect=5, read=25, write=15, pool=1)
+TG_HTTP = httpx.AsyncClient(
+    base_url=TG_API,
+    http2=True,
+    timeout=TG_TIMEOUT,
+    headers={"Content-Type": "application/json"},
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+)
+TG_FILE_HTTP = httpx.AsyncClient(http2=True, timeout=120)
+
+
+class _RetryTransport(httpx.AsyncBaseTransport):
+    """Retry idempotent requests on transient gateway errors (502/503/504) with backoff.
+    Connect errors are retried by the wrapped transport itself."""
+
+    RETRY_STATUSES = frozenset({502, 503, 504})
+    # No PUT: a GitHub contents PUT may have been applied before the gateway error, and replaying
+    # it with the old sha turns a successful commit into a 409/422
+    IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "DELETE", "OPTIONS"})
+
+    def __init__(self, total: int = 3, backoff_factor: float = 0.2, **transport_kwargs: Any) -> None:
+        self._inner = httpx.AsyncHTTPTransport(retries=total, **transport_kwargs)
+        self._total = total
+        self._backoff = backoff_factor
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            response = await self._inner.handle_async_request(request)
+            if (
+                response.status_code not in self.RETRY_STATUSES
+                or request.method not in self.IDEMPOTENT_METHODS
+                or attempt >= self._total
+            ):
+                return response
+            await response.aclose()
+            await asyncio.sleep(self._backoff * (2 ** attempt))
+            attempt += 1
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+
+
+# GitHub: shared async client (keep-alive pool, auth + API headers preset).
+_GH_HEADERS = {
+    "Accept": "application/vnd.github+json",
+    "X-GitHub-Api-Version": "2022-11-28",
+    "User-Agent": f"play4good-bot/{BOT_VERSION}",
+    "Content-Type": "application/json",  # bodies are pre-serialized with orjson
+}
+if GITHUB_TOKEN:
+    _GH_HEADERS["Authorization"] = f"Bearer {GITHUB_TOKEN}"
+GH_HTTP = httpx.AsyncClient(
+    timeout=30,
+    headers=_GH_HEADERS,
+    transport=_RetryTransport(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+    ),
+)
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Idle Telegram connections get closed server-side; ping periodically so bursts after
+# a quiet period don't pay a fresh TLS handshake. 0 disables.
+KEEPALIVE_INTERVAL_SECONDS = int(os.environ.get("KEEPALIVE_INTERVAL_SECONDS", "60"))
+# TTLCache only evicts expired entries when touched; sweep so idle caches release memory too.
+CACHE_SWEEP_INTERVAL_SECONDS = 60
+_maintenance_tasks: List[asyncio.Task] = []
+
+
+async def _warm_connections() -> None:
+    """Open Telegram/GitHub/OpenAI connections before the first update needs them."""
+    checks = {
+        "telegram": TG_HTTP.get("/getMe", timeout=10),
+        "github": GH_HTTP.get(GH_API, timeout=10),
+        "openai": client.models.list(),
+    }
+    results = await asyncio.gather(*checks.values(), return_exceptions=True)
+    for name, res in zip(checks, results):
+        if isinstance(res, Exception):
+            print(f"[WARMUP] {name} failed: {type(res).__name__}: {res}")
+
+
+async def _keepalive() -> None:
+    while True:
+        await asyncio.sleep(KEEPALIVE_INTERVAL_SECONDS)
+        try:
+            await TG_HTTP.get("/getMe", timeout=10)
+        except Exception as e:
+            print(f"[KEEPALIVE] telegram ping failed: {type(e).__name__}: {e}")
+
+
+async def _sweep_caches() -> None:
+    while True:
+        await asyncio.sleep(CACHE_SWEEP_INTERVAL_SECONDS)
+        # Every module-level TTLCache; add new caches here so idle entries are dropped
+        for cache in (
+            DEV_CHAT, BRANCH_JUST_CREATED, LAST_DEPLOY_URL, RECENTLY_MERGED, RECENTLY_COMPLETED,
+            APPROVAL_AWAITING_FEEDBACK, PENDING, ARMED, _SEEN_UPDATES, _STATE_L1, _TG_BUCKETS,
+            _FILE_PATH_CACHE, _TRANSCRIPT_CACHE, _GH_ETAG_CACHE, _DEFAULT_BRANCH_CACHE,
+            _SCREENSHOT_URLS, _KNOWN_BRANCHES,
+        ):
+            cache.expire()
+
+
+@app.on_event("startup")
+async def _start_connections() -> None:
+    spawn_background(_warm_connections(), name="warmup")
+    if KEEPALIVE_INTERVAL_SECONDS > 0:
+        _maintenance_tasks.append(asyncio.create_task(_keepalive()))
+    _maintenance_tasks.append(asyncio.create_task(_sweep_caches()))
+    _maintenance_tasks.append(asyncio.create_task(_sweep_state()))
+    if redis_client is not None:
+        # Only Redis can hold entries written by an older release
+        await _migrate_approvals()
+        _maintenance_tasks.append(asyncio.create_task(_listen_state_invalidations()))
+        _maintenance_tasks.append(asyncio.create_task(_listen_ci_progress()))
+
+
+@app.on_event("shutdown")
+async def _close_http_clients() -> None:
+    for task in _maintenance_tasks:
+        task.cancel()
+    await TG_HTTP.aclose()
+    await TG_FILE_HTTP.aclose()
+    await GH_HTTP.aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
+
+
+@app.middleware("http")
+async def _timing(request: Request, call_next):
+    t0 = time.perf_counter()
+    resp = await call_next(request)
+    dt = time.perf_counter() - t0
+    if dt > SLOW_REQUEST_SECONDS:
+        print(f"[SLOW] {request.method} {request.url.path} {dt:.2f}s")
+    resp.headers["X-Elapsed-ms"] = f"{dt * 1000:.1f}"
+    return resp
+
 
 print(f"[BOT] version={BOT_VERSION} build={BUILD_ID} started_at={BOT_STARTED_AT}")
 print(f"[BOT] GITHUB_REPO={GITHUB_REPO} REQUIRE_TICKET_CMD={REQUIRE_TICKET_COMMAND}")
@@ -293,15 +476,450 @@ print(f"[BOT] NETLIFY_SITE_MAP={NETLIFY_SITE_MAP}")
 print(f"[BOT] NETLIFY_APP_PATHS={NETLIFY_APP_PATHS}")
 print(f"[BOT] _REPO_TO_SITE={_REPO_TO_SITE}")
 print(f"[BOT] PERSIST_DIR={_PERSIST_DIR}")
+print(f"[BOT] REDIS={'on' if REDIS_URL else 'off (in-memory state)'}")
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+if WEB_CONCURRENCY > 1:
+    if not REDIS_URL:
+        print(f"[WARN] WEB_CONCURRENCY={WEB_CONCURRENCY} without REDIS_URL: drafts and CI state will split across workers")
+    else:
+        print(f"[WARN] WEB_CONCURRENCY={WEB_CONCURRENCY}: /repo choice and Netlify deploy grace periods stay per-worker")
 print(f"[BOT] WEBAPP_PROD={WEBAPP_URL_PRODUCTION or '(empty)'}")
 print(f"[BOT] WEBAPP_DEV1={WEBAPP_URL_DEV_1 or '(empty)'} ({WEBAPP_DEV_1_NAME})")
 print(f"[BOT] WEBAPP_DEV2={WEBAPP_URL_DEV_2 or '(empty)'} ({WEBAPP_DEV_2_NAME})")
-print(f"[BOT] DEVELOPER_MAP={DEVELOPER_MAP}")
+print(f"[BOT] DEVELOPER_MAP={dict(DEVELOPER_MAP)}")
 
-# ===== In-memory state. For production/multi-instance use Redis. =====
+# ===== Draft state =====
 # key = f"{chat_id}:{user_id}"
-PENDING: Dict[str, Dict[str, Any]] = {}
-ARMED: Dict[str, int] = {}  # key chat_id:user_id -> expires_at unix
+# PENDING/ARMED live in Redis when REDIS_URL is set (any worker can serve the callback click),
+# otherwise in this process. Both expire: abandoned drafts and unused /ticket arms don't pile up.
+# Access them only through the pending_* / armed_* helpers.
+PENDING_TTL_SECONDS = 3600  # typical ticket authoring window
+redis_client: Optional[aioredis.Redis] = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+PENDING: TTLCache = TTLCache(maxsize=10_000, ttl=PENDING_TTL_SECONDS)
+ARMED: TTLCache = TTLCache(maxsize=10_000, ttl=ARM_TTL_SECONDS)  # /ticket -> next voice accepted
+
+
+async def pending_get(key: str) -> Optional[Dict[str, Any]]:
+    if redis_client is None:
+        return PENDING.get(key)
+    raw = await redis_client.get(f"pending:{key}")
+    return orjson.loads(raw) if raw else None
+
+
+async def pending_set(key: str, state: Dict[str, Any]) -> None:
+    if redis_client is None:
+        PENDING[key] = state
+        return
+    await redis_client.set(f"pending:{key}", orjson.dumps(state), ex=PENDING_TTL_SECONDS)
+
+
+async def pending_pop(key: str) -> None:
+    if redis_client is None:
+        PENDING.pop(key, None)
+        return
+    await redis_client.delete(f"pending:{key}")
+
+
+async def armed_set(key: str) -> None:
+    if redis_client is None:
+        ARMED[key] = True
+        return
+    await redis_client.set(f"armed:{key}", "1", ex=ARM_TTL_SECONDS)
+
+
+async def armed_check(key: str) -> bool:
+    if redis_client is None:
+        return key in ARMED
+    return bool(await redis_client.exists(f"armed:{key}"))
+
+
+async def armed_pop(key: str) -> None:
+    if redis_client is None:
+        ARMED.pop(key, None)
+        return
+    await redis_client.delete(f"armed:{key}")
+
+
+# Create-click lock: a double tap on "Создать" must not open two GitHub issues.
+CREATE_LOCK_TTL_SECONDS = 30
+_CREATE_LOCKS: set = set()
+
+
+async def create_lock_acquire(key: str) -> bool:
+    if redis_client is None:
+        if key in _CREATE_LOCKS:
+            return False
+        _CREATE_LOCKS.add(key)
+        return True
+    return bool(await redis_client.set(f"lock:{key}", "1", nx=True, ex=CREATE_LOCK_TTL_SECONDS))
+
+
+async def create_lock_release(key: str) -> None:
+    if redis_client is None:
+        _CREATE_LOCKS.discard(key)
+        return
+    await redis_client.delete(f"lock:{key}")
+
+
+# Telegram redelivers updates it thinks failed; update_id makes processing idempotent.
+SEEN_UPDATE_TTL_SECONDS = 3600
+_SEEN_UPDATES: TTLCache = TTLCache(maxsize=10_000, ttl=SEEN_UPDATE_TTL_SECONDS)
+
+
+async def mark_update_seen(update_id: Any) -> bool:
+    """Record update_id (or any delivery key); False if it was already seen (a redelivery)."""
+    if redis_client is None:
+        if update_id in _SEEN_UPDATES:
+            return False
+        _SEEN_UPDATES[update_id] = True
+        return True
+    return bool(await redis_client.set(f"upd:{update_id}", "1", nx=True, ex=SEEN_UPDATE_TTL_SECONDS))
+
+
+async def _count_keys(pattern: str) -> int:
+    return len([k async for k in redis_client.scan_iter(match=pattern)])
+
+
+async def pending_total() -> int:
+    if redis_client is None:
+        return len(PENDING)
+    return await _count_keys("pending:*")
+
+
+async def armed_total() -> int:
+    if redis_client is None:
+        return len(ARMED)
+    return await _count_keys("armed:*")
+
+
+# ===== CI / notification state =====
+# DEV_CHAT / ACTIVE_TICKET / CI_PROGRESS / APPROVAL_* follow the same switch as drafts: one Redis hash
+# per namespace ("state:<ns>", JSON values) when REDIS_URL is set, so GitHub/Netlify callbacks can land
+# on any worker and survive redeploys; otherwise the dicts above. Access them only through state_*.
+_STATE_DICTS: Dict[str, Dict[Any, Any]] = {
+    "dev_chat": DEV_CHAT,
+    "active": ACTIVE_TICKET,
+    "ci": CI_PROGRESS,
+    "approval": APPROVAL_REQUESTS,
+    "approval_issue": APPROVAL_BY_ISSUE,
+    "feedback": APPROVAL_AWAITING_FEEDBACK,
+}
+
+
+# Hot namespaces (read on every GitHub/Claude/Netlify callback) get a per-worker L1 in front of Redis.
+# Writes publish "<worker>|<ns>|<key>" so peer workers drop their copy. L1 holds the JSON bytes Redis
+# accepted, and every hit decodes a fresh object, so callers mutating the result can't skew the cache.
+_L1_NAMESPACES = frozenset({"dev_chat", "active", "ci"})
+_STATE_L1: TTLCache = TTLCache(maxsize=256, ttl=60)
+STATE_INVALIDATE_CHANNEL = "state:invalidate"
+_WORKER_ID = os.urandom(4).hex()
+
+
+async def _state_changed(ns: str, key: str, raw: Optional[bytes]) -> None:
+    if ns not in _L1_NAMESPACES:
+        return
+    if raw is None:
+        _STATE_L1.pop((ns, key), None)
+    else:
+        _STATE_L1[(ns, key)] = raw
+    await redis_client.publish(STATE_INVALIDATE_CHANNEL, f"{_WORKER_ID}|{ns}|{key}")
+
+
+async def state_get(ns: str, key: Any) -> Any:
+    if redis_client is None:
+        return _STATE_DICTS[ns].get(key)
+    key = str(key)
+    raw = _STATE_L1.get((ns, key))
+    if raw is None:
+        raw = await redis_client.hget(f"state:{ns}", key)
+        if not raw:
+            return None
+        if ns in _L1_NAMESPACES:
+            _STATE_L1[(ns, key)] = raw
+    return orjson.loads(raw)
+
+
+async def state_set(ns: str, key: Any, value: Any) -> None:
+    if redis_client is None:
+        _STATE_DICTS[ns][key] = value
+        return
+    key = str(key)
+    raw = orjson.dumps(value)
+    await redis_client.hset(f"state:{ns}", key, raw)
+    await _state_changed(ns, key, raw)
+
+
+async def state_pop(ns: str, key: Any) -> Any:
+    if redis_client is None:
+        return _STATE_DICTS[ns].pop(key, None)
+    key = str(key)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        raw, _ = await pipe.hget(f"state:{ns}", key).hdel(f"state:{ns}", key).execute()
+    await _state_changed(ns, key, None)
+    return orjson.loads(raw) if raw else None
+
+
+async def state_all(ns: str) -> Dict[Any, Any]:
+    if redis_client is None:
+        return dict(_STATE_DICTS[ns])
+    raw = await redis_client.hgetall(f"state:{ns}")
+    return {k.decode(): orjson.loads(v) for k, v in raw.items()}
+
+
+async def state_update(ns: str, key: Any, fn: Callable[[Any], Any]) -> Any:
+    """Read-modify-write one entry: fn gets the current value (None when absent) and returns the new one,
+    or None to leave it untouched. Returns what was written. Atomic across workers: with Redis the write is
+    a WATCH/MULTI on the namespace hash, retried when anyone wrote to it in between; without Redis there
+    is no await between read and write."""
+    if redis_client is None:
+        value = fn(_STATE_DICTS[ns].get(key))
+        if value is not None:
+            _STATE_DICTS[ns][key] = value
+        return value
+    key, name = str(key), f"state:{ns}"
+    # The local lock keeps this worker's writers from retrying against each other
+    async with state_lock(ns, key), redis_client.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                await pipe.watch(name)
+                raw = await pipe.hget(name, key)
+                value = fn(orjson.loads(raw) if raw else None)
+                if value is None:
+                    return None
+                raw = orjson.dumps(value)
+                pipe.multi()
+                pipe.hset(name, key, raw)
+                await pipe.execute()
+                break
+            except aioredis.WatchError:
+                continue
+    await _state_changed(ns, key, raw)
+    return value
+
+
+async def state_pop_if(ns: str, key: Any, expected: Any) -> bool:
+    """Drop the entry only if it still equals expected (compare-and-delete, atomic like state_update)."""
+    if redis_client is None:
+        if _STATE_DICTS[ns].get(key) != expected:
+            return False
+        del _STATE_DICTS[ns][key]
+        return True
+    key, name = str(key), f"state:{ns}"
+    async with redis_client.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                await pipe.watch(name)
+                raw = await pipe.hget(name, key)
+                if not raw or orjson.loads(raw) != expected:
+                    return False
+                pipe.multi()
+                pipe.hdel(name, key)
+                await pipe.execute()
+                break
+            except aioredis.WatchError:
+                continue
+    await _state_changed(ns, key, None)
+    return True
+
+
+async def _listen_state_invalidations() -> None:
+    """Drop L1 entries that another worker has just written."""
+    while True:
+        try:
+            async with redis_client.pubsub() as pubsub:
+                await pubsub.subscribe(STATE_INVALIDATE_CHANNEL)
+                async for msg in pubsub.listen():
+                    if msg.get("type") != "message":
+                        continue
+                    origin, ns, key = msg["data"].decode().split("|", 2)
+                    if origin != _WORKER_ID:
+                        _STATE_L1.pop((ns, key), None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[STATE] invalidation listener failed: {type(e).__name__}: {e}")
+            _STATE_L1.clear()  # missed messages while disconnected — start cold
+            await asyncio.sleep(1)
+
+
+# Live CI progress for /ci/progress/stream listeners: in-process queues per ctx. With REDIS_URL the update
+# goes through Redis channel "ci:<ctx>" (the writer may sit on another worker) and one pattern subscription
+# per worker (_listen_ci_progress) fans it out to the local queues. Payload: progress JSON, or null when idle.
+_CI_SUBSCRIBERS: Dict[str, set] = {}
+
+
+def _ci_fanout(ctx: str, data: bytes) -> None:
+    for queue in _CI_SUBSCRIBERS.get(ctx, ()):
+        try:
+            queue.put_nowait(data)
+        except asyncio.QueueFull:
+            pass  # slow listener: it will get the next update
+
+
+async def ci_progress_publish(ctx: str, progress: Optional[Dict[str, Any]]) -> None:
+    data = orjson.dumps(progress)
+    if redis_client is not None:
+        await redis_client.publish(f"ci:{ctx}", data)
+        return
+    _ci_fanout(ctx, data)
+
+
+async def _listen_ci_progress() -> None:
+    """Single Redis subscription per worker feeding every local SSE listener."""
+    while True:
+        try:
+            async with redis_client.pubsub() as pubsub:
+                await pubsub.psubscribe("ci:*")
+                async for msg in pubsub.listen():
+                    if msg.get("type") == "pmessage":
+                        _ci_fanout(msg["channel"].decode()[3:], msg["data"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[CI] progress listener failed: {type(e).__name__}: {e}")
+            await asyncio.sleep(1)
+
+
+# Per-key asyncio locks (per process) for sequences that must not interleave within a worker: Telegram
+# sends to one chat, and state_update calls on one key (across workers Redis WATCH keeps those atomic).
+# Weak values: a lock disappears once nobody holds or waits on it.
+_STATE_LOCKS: "weakref.WeakValueDictionary[Tuple[str, str], asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def state_lock(ns: str, key: Any) -> asyncio.Lock:
+    lock_key = (ns, str(key))
+    lock = _STATE_LOCKS.get(lock_key)
+    if lock is None:
+        lock = _STATE_LOCKS[lock_key] = asyncio.Lock()
+    return lock
+
+
+async def ci_progress_save(ctx: str, progress: Optional[Dict[str, Any]]) -> None:
+    """Store (or, with None, drop) CI_PROGRESS[ctx] and notify stream listeners."""
+    if progress is None:
+        await state_pop("ci", ctx)
+    else:
+        await state_set("ci", ctx, progress)
+    await ci_progress_publish(ctx, progress)
+
+
+# Approval entries are GC'd after a day: the workflow stops polling long before that.
+APPROVAL_TTL_SECONDS = 86400
+# CI progress with no update for a week belongs to a run that never reported back
+CI_PROGRESS_STALE_SECONDS = 7 * 86400
+
+
+async def approval_set(approval_key: str, status: str, feedback: Optional[str] = None,
+                       only_pending: bool = False) -> bool:
+    """Write APPROVAL_REQUESTS[approval_key] and keep the issue → pending-key index in step.
+    With only_pending, the status changes only if the request is still pending (False otherwise),
+    so two clicks on any workers resolve it once."""
+    def write(entry: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        if only_pending and (not entry or entry.get("status") != "pending"):
+            return None
+        created_at = entry.get("created_at") if entry else None
+        return {"status": status, "feedback": feedback, "created_at": created_at or now_ts()}
+
+    if await state_update("approval", approval_key, write) is None:
+        return False
+    issue = approval_key.rsplit(":", 1)[-1]
+    if status == "pending":
+        await state_set("approval_issue", issue, approval_key)
+    else:
+        await state_pop_if("approval_issue", issue, approval_key)
+    return True
+
+
+async def approval_find_pending(issue: str) -> Optional[str]:
+    """approval_key of the pending request for this issue number, if any."""
+    approval_key = await state_get("approval_issue", issue)
+    entry = await state_get("approval", approval_key) if approval_key else None
+    return approval_key if entry and entry["status"] == "pending" else None
+
+
+async def _migrate_approvals() -> None:
+    """One-off: approval entries used to be bare status strings; rewrite them as dicts."""
+    try:
+        for approval_key, entry in (await state_all("approval")).items():
+            if isinstance(entry, str):
+                await state_set("approval", approval_key, {"status": entry, "feedback": None, "created_at": now_ts()})
+                print(f"[APPROVAL] Migrated legacy entry {approval_key} → {entry}")
+    except Exception as e:
+        print(f"[APPROVAL] Legacy entry migration failed: {type(e).__name__}: {e}")
+
+
+async def _sweep_state() -> None:
+    """Hourly GC for state namespaces that have no TTL of their own (Redis hashes, plain dicts)."""
+    while True:
+        await asyncio.sleep(3600)
+        try:
+            await _sweep_state_once()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[SWEEP] state sweep failed: {type(e).__name__}: {e}")
+
+
+async def _sweep_state_once() -> None:
+    now = now_ts()
+    cutoff = now - APPROVAL_TTL_SECONDS
+    for approval_key, entry in (await state_all("approval")).items():
+        if entry.get("created_at", 0) >= cutoff:
+            continue
+        await state_pop("approval", approval_key)
+        await state_pop_if("approval_issue", approval_key.rsplit(":", 1)[-1], approval_key)
+    # Feedback prompts for requests that are no longer pending can't be answered
+    for chat_id, awaiting in (await state_all("feedback")).items():
+        if not await approval_find_pending(awaiting.get("issue_number", "")):
+            await state_pop("feedback", chat_id)
+    # DEV_CHAT's TTLCache only bounds the in-memory mode; the Redis hash gets the same age limit here
+    cutoff = now - DEV_CHAT_TTL_SECONDS
+    for ctx, dev_ctx in (await state_all("dev_chat")).items():
+        if "updated_at" not in dev_ctx:  # written before entries were stamped: start their clock now
+            await state_update("dev_chat", ctx, lambda v: {**v, "updated_at": now} if v and "updated_at" not in v else None)
+        elif dev_ctx["updated_at"] < cutoff:
+            await state_pop_if("dev_chat", ctx, dev_ctx)  # unless re-written meanwhile
+    cutoff = now - CI_PROGRESS_STALE_SECONDS
+    for ctx, progress in (await state_all("ci")).items():
+        if progress.get("last_update_at", 0) < cutoff:
+            await ci_progress_save(ctx, None)
+            print(f"[SWEEP] Dropped stale CI progress for {ctx}")
+
+
+async def ci_progress_update(ctx: str, **fields: Any) -> None:
+    """Merge fields into CI_PROGRESS[ctx]; no-op when no ticket is tracked for ctx."""
+    def merge(progress: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        if progress is None:
+            return None
+        progress.update(fields)
+        return progress
+
+    progress = await state_update("ci", ctx, merge)
+    if progress is not None:
+        await ci_progress_publish(ctx, progress)
+
+
+async def ci_progress_enter_phase(ctx: str, phase_num: str, phase_name: str) -> None:
+    """Record phase_num as current and move the previous phase to phases_done."""
+    def advance(progress: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        if progress is None:
+            return None
+        now = now_ts()
+        prev = progress.get("current_phase_num", "")
+        if prev and prev != phase_num:
+            done = progress.get("phases_done") or {}
+            if isinstance(done, list):  # entries saved before phases_done became a dict
+                done = dict.fromkeys(done, 0)
+            done.setdefault(prev, now)
+            progress["phases_done"] = done
+        progress["current_phase_num"] = phase_num
+        progress["last_phase"] = phase_name
+        progress["last_update_at"] = now
+        return progress
+
+    progress = await state_update("ci", ctx, advance)
+    if progress is not None:
+        await ci_progress_publish(ctx, progress)
 
 
 # ===================== UTIL =====================
@@ -317,56 +935,161 @@ def now_ts() -> int:
     return int(time.time())
 
 
-def parse_labels() -> List[str]:
-    return [x.strip() for x in GITHUB_LABELS.split(",") if x.strip()]
+_HTML_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
 
 
 def html_escape(s: str) -> str:
-    """Escape HTML special characters for Telegram HTML parse_mode."""
-    return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    """Escape HTML special characters for Telegram HTML parse_mode (single pass)."""
+    return s.translate(_HTML_ESCAPE)
+
+
+def timed(fn):
+    """Log wall-clock time of an async helper as `[TIMING] fn=... ms=... ok=...`."""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            result = await fn(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            print(f"[TIMING] fn={fn.__name__} ms={(time.perf_counter() - t0) * 1000:.1f} ok={ok}")
+    return wrapper
+
+
+# "/ticket", "/ticket text", "/ticket@botname text" (Telegram appends @botname in groups);
+# "/tickets" etc. don't match. One anchored match, no strip() copy of every message.
+# Greedy tail + strip(): a lazy group before a trailing \s* backtracks quadratically on long whitespace runs
+_TICKET_RE = re.compile(r"\s*/ticket(?:@\S*)?(?:\s+(.*))?", re.DOTALL)
 
 
 def extract_ticket_command(text: str) -> Tuple[bool, str]:
-    t = (text or "").strip()
-    if not t:
-        return False, ""
-    if t.startswith("/ticket"):
-        rest = t[len("/ticket"):].strip()
-        # Strip @botname suffix if present
-        if rest.startswith("@"):
-            parts = rest.split(" ", 1)
-            rest = parts[1].strip() if len(parts) > 1 else ""
-        return True, rest
-    return False, ""
+    m = _TICKET_RE.fullmatch(text) if text else None
+    return (True, (m.group(1) or "").strip()) if m else (False, "")
 
 
 # ===================== TELEGRAM HELPERS =====================
-def tg_send_message(chat_id: int, text: str, reply_to_message_id: Optional[int] = None) -> None:
+# Outbound rate limits (Bot API: ~30 msg/s per bot, ~1 msg/s per chat with short bursts tolerated).
+# Token buckets with reservation: a sender sleeps until its slot instead of provoking a 429.
+TG_GLOBAL_RATE, TG_GLOBAL_BURST = 30.0, 30
+TG_CHAT_RATE, TG_CHAT_BURST = 1.0, 5
+_TG_RATE_LIMITED = frozenset({"sendMessage", "editMessageText", "editMessageReplyMarkup"})
+_TG_BUCKETS: TTLCache = TTLCache(maxsize=10_000, ttl=600)  # key → (tokens, last_refill)
+
+
+def _bucket_wait(key: Any, rate: float, burst: int, now: float) -> float:
+    tokens, last = _TG_BUCKETS.get(key, (burst, now))
+    tokens = min(burst, tokens + (now - last) * rate) - 1
+    _TG_BUCKETS[key] = (tokens, now)
+    return 0.0 if tokens >= 0 else -tokens / rate
+
+
+async def tg_throttle(chat_id: Any) -> None:
+    now = time.monotonic()
+    wait = max(
+        _bucket_wait("*", TG_GLOBAL_RATE, TG_GLOBAL_BURST, now),
+        _bucket_wait(chat_id, TG_CHAT_RATE, TG_CHAT_BURST, now),
+    )
+    if wait > 0:
+        await asyncio.sleep(wait)
+
+
+async def tg_call(method: str, payload: Dict[str, Any], timeout: Optional[httpx.Timeout] = None) -> Dict[str, Any]:
+    """POST a Bot API method: payload serialized once with orjson, response parsed as JSON.
+    Message sends/edits are throttled; a 429 is retried once after Telegram's retry_after."""
+    if method in _TG_RATE_LIMITED and "chat_id" in payload:
+        await tg_throttle(payload["chat_id"])
+    body = orjson.dumps(payload)
+    r = await TG_HTTP.post(f"/{method}", content=body, timeout=timeout or TG_TIMEOUT)
+    resp = orjson.loads(r.content)
+    if resp.get("error_code") == 429:
+        retry_after = min(resp.get("parameters", {}).get("retry_after", 1), 30)
+        print(f"[TG] 429 on {method}, retrying in {retry_after}s")
+        await asyncio.sleep(retry_after)
+        r = await TG_HTTP.post(f"/{method}", content=body, timeout=timeout or TG_TIMEOUT)
+        resp = orjson.loads(r.content)
+    return resp
+
+
+async def tg_send_message(chat_id: int, text: str, reply_to_message_id: Optional[int] = None) -> None:
     payload: Dict[str, Any] = {"chat_id": chat_id, "text": text}
     if reply_to_message_id is not None:
         payload["reply_to_message_id"] = reply_to_message_id
         payload["allow_sending_without_reply"] = True
-    r = requests.post(f"{TG_API}/sendMessage", json=payload, timeout=30)
-    resp = r.json()
+    async with state_lock("tg_chat", chat_id):
+        await _outbox_send(chat_id)
+        resp = await tg_call("sendMessage", payload)
     if not resp.get("ok"):
         print(f"[TG ERROR] sendMessage failed: {resp.get('error_code')} {resp.get('description')}")
 
 
-def tg_send_html(chat_id: int, html: str, reply_to_message_id: int | None = None) -> None:
+async def tg_send_html(chat_id: int, html: str, reply_to_message_id: int | None = None) -> None:
     """Send message with HTML parse_mode (for user mentions etc)."""
+    async with state_lock("tg_chat", chat_id):
+        await _outbox_send(chat_id)
+        await _tg_send_html(chat_id, html, reply_to_message_id)
+
+
+async def _tg_send_html(chat_id: int, html: str, reply_to_message_id: int | None = None) -> None:
     payload: Dict[str, Any] = {"chat_id": chat_id, "text": html, "parse_mode": "HTML"}
     if reply_to_message_id:
         payload["reply_to_message_id"] = reply_to_message_id
-    r = requests.post(f"{TG_API}/sendMessage", json=payload, timeout=30)
-    resp = r.json()
+    resp = await tg_call("sendMessage", payload)
     if not resp.get("ok"):
         print(f"[TG_HTML ERROR] {resp.get('error_code')} {resp.get('description')}")
         print(f"[TG_HTML ERROR] chat_id={chat_id} text={html[:200]}")
-        # Fallback: try without HTML parse_mode
-        fallback_payload: Dict[str, Any] = {"chat_id": chat_id, "text": html}
-        if reply_to_message_id:
-            fallback_payload["reply_to_message_id"] = reply_to_message_id
-        requests.post(f"{TG_API}/sendMessage", json=fallback_payload, timeout=30)
+        # Fallback: same payload without HTML parse_mode
+        del payload["parse_mode"]
+        await tg_call("sendMessage", payload)
+
+
+# Notification outbox: CI notices to one chat arriving within OUTBOX_WINDOW_SECONDS go out as one message.
+# Delivery is fire-and-forget (the webhook has already answered), so failures are only logged.
+# Every send to a chat — outbox flush or direct — holds state_lock("tg_chat", chat_id), and direct
+# sends flush pending notices first: notices never land after a later direct message, and the
+# chunks of an over-long batch are not interleaved with one.
+OUTBOX_WINDOW_SECONDS = 0.2
+TG_MAX_TEXT = 4096
+_OUTBOX: Dict[int, List[str]] = {}
+
+
+async def tg_notify(chat_id: int, html: str) -> None:
+    """Queue an HTML notice for chat_id; returns immediately."""
+    pending = _OUTBOX.get(chat_id)
+    if pending is not None:
+        pending.append(html)
+        return
+    _OUTBOX[chat_id] = [html]
+    spawn_background(_outbox_flush_later(chat_id), name=f"outbox-{chat_id}")
+
+
+async def _outbox_flush_later(chat_id: int) -> None:
+    await asyncio.sleep(OUTBOX_WINDOW_SECONDS)
+    await tg_outbox_flush(chat_id)
+
+
+async def tg_outbox_flush(chat_id: int) -> None:
+    async with state_lock("tg_chat", chat_id):
+        await _outbox_send(chat_id)
+
+
+async def _outbox_send(chat_id: int) -> None:
+    """Send the chat's pending notices; caller holds state_lock("tg_chat", chat_id)."""
+    pending = _OUTBOX.pop(chat_id, None)
+    if not pending:
+        return
+    batches = [""]
+    for html in pending:
+        if batches[-1] and len(batches[-1]) + 2 + len(html) > TG_MAX_TEXT:
+            batches.append(html)
+        else:
+            batches[-1] = f"{batches[-1]}\n\n{html}" if batches[-1] else html
+    for batch in batches:
+        try:
+            await _tg_send_html(chat_id, batch)
+        except Exception as e:
+            print(f"[OUTBOX] chat_id={chat_id} notice not delivered: {type(e).__name__}: {e} text={batch[:200]}")
 
 
 def tg_mention(user_id: int, first_name: str) -> str:
@@ -375,7 +1098,12 @@ def tg_mention(user_id: int, first_name: str) -> str:
     return f'<a href="tg://user?id={user_id}">{safe_name}</a>'
 
 
-def tg_send_message_with_keyboard(
+def dev_name_html(dev_ctx: Dict[str, Any]) -> str:
+    """Escaped first name from a DEV_CHAT entry (stored at ticket creation; older entries lack it)."""
+    return dev_ctx.get("first_name_html") or html_escape(dev_ctx["first_name"])
+
+
+async def tg_send_message_with_keyboard(
     chat_id: int,
     text: str,
     keyboard: List[List[Dict[str, str]]],
@@ -392,15 +1120,16 @@ def tg_send_message_with_keyboard(
     if reply_to_message_id is not None:
         payload["reply_to_message_id"] = reply_to_message_id
         payload["allow_sending_without_reply"] = True
-    r = requests.post(f"{TG_API}/sendMessage", json=payload, timeout=30)
-    resp = r.json()
+    async with state_lock("tg_chat", chat_id):
+        await _outbox_send(chat_id)
+        resp = await tg_call("sendMessage", payload)
     if not resp.get("ok"):
         print(f"[TG ERROR] sendMessage failed: {resp.get('error_code')} {resp.get('description')}")
         print(f"[TG ERROR] payload keys: {list(payload.keys())}, keyboard_rows: {len(keyboard)}")
     return resp
 
 
-def tg_edit_message_with_keyboard(
+async def tg_edit_message_with_keyboard(
     chat_id: int,
     message_id: int,
     text: str,
@@ -416,73 +1145,207 @@ def tg_edit_message_with_keyboard(
     }
     if parse_mode:
         payload["parse_mode"] = parse_mode
-    r = requests.post(f"{TG_API}/editMessageText", json=payload, timeout=30)
-    resp = r.json()
+    resp = await tg_call("editMessageText", payload)
     if not resp.get("ok"):
         print(f"[TG EDIT ERROR] {resp.get('error_code')} {resp.get('description')}")
     return resp
 
 
-def tg_answer_callback(callback_id: str, text: Optional[str] = None, show_alert: bool = False) -> None:
+async def tg_edit_reply_markup(chat_id: int, message_id: int, keyboard: List[List[Dict[str, str]]]) -> Optional[Dict[str, Any]]:
+    """Replace only the inline keyboard of a message (text untouched)."""
+    resp = await tg_call("editMessageReplyMarkup", {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "reply_markup": {"inline_keyboard": keyboard},
+    })
+    if not resp.get("ok") and "not modified" not in (resp.get("description") or ""):
+        print(f"[TG EDIT ERROR] {resp.get('error_code')} {resp.get('description')}")
+    return resp
+
+
+async def tg_answer_callback(callback_id: str, text: Optional[str] = None, show_alert: bool = False) -> None:
     payload: Dict[str, Any] = {"callback_query_id": callback_id}
     if text:
         payload["text"] = text
         payload["show_alert"] = show_alert
-    requests.post(f"{TG_API}/answerCallbackQuery", json=payload, timeout=10)
+    await tg_call("answerCallbackQuery", payload, timeout=httpx.Timeout(10, connect=5, pool=1))
 
 
-def tg_get_file_path(file_id: str) -> Optional[str]:
-    r = requests.get(f"{TG_API}/getFile", params={"file_id": file_id}, timeout=30)
-    return r.json().get("result", {}).get("file_path")
+# getFile results: file paths stay downloadable for ~1 hour (Telegram file link TTL).
+_FILE_PATH_CACHE: TTLCache = TTLCache(maxsize=4096, ttl=3600)
 
 
-def tg_download_file(file_path: str, dst_path: str) -> None:
-    url = f"{TG_FILE_API}/{file_path}"
-    with requests.get(url, stream=True, timeout=120) as r:
-        r.raise_for_status()
-        with open(dst_path, "wb") as f:
-            for chunk in r.iter_content(1024 * 256):
-                if chunk:
-                    f.write(chunk)
+async def tg_get_file_path(file_id: str) -> Optional[str]:
+    cached = _FILE_PATH_CACHE.get(file_id)
+    if cached:
+        return cached
+    r = await TG_HTTP.get("/getFile", params={"file_id": file_id})
+    file_path = orjson.loads(r.content).get("result", {}).get("file_path")
+    if file_path:
+        _FILE_PATH_CACHE[file_id] = file_path
+    return file_path
 
 
-def tg_download_file_bytes(file_path: str) -> bytes:
-    url = f"{TG_FILE_API}/{file_path}"
-    r = requests.get(url, timeout=120)
-    r.raise_for_status()
-    return r.content
+DOWNLOAD_CHUNK_BYTES = 1 << 20
+
+
+async def tg_download_file_bytes(file_path: str) -> bytes:
+    """Stream a Bot API file in 1 MiB reads, refusing anything past the Bot API download limit."""
+    async with TG_FILE_HTTP.stream("GET", f"{TG_FILE_API}/{file_path}") as r:
+        r.raise_for_status()
+        if int(r.headers.get("content-length") or 0) > MAX_AUDIO_BYTES:
+            raise RuntimeError(f"File too large: {r.headers['content-length']} bytes")
+        buf = bytearray()
+        async for chunk in r.aiter_bytes(DOWNLOAD_CHUNK_BYTES):
+            buf += chunk
+            if len(buf) > MAX_AUDIO_BYTES:
+                raise RuntimeError(f"File too large: >{MAX_AUDIO_BYTES} bytes")
+    return bytes(buf)
+
+
+async def tg_fetch_file(file_id: str) -> Optional[Tuple[str, bytes]]:
+    """getFile + download; a stale cached path (404) is dropped and resolved once more."""
+    file_path = await tg_get_file_path(file_id)
+    if not file_path:
+        return None
+    try:
+        return file_path, await tg_download_file_bytes(file_path)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code != 404:
+            raise
+    _FILE_PATH_CACHE.pop(file_id, None)
+    file_path = await tg_get_file_path(file_id)
+    if not file_path:
+        return None
+    return file_path, await tg_download_file_bytes(file_path)
 
 
 # ===================== AUDIO =====================
-def ffmpeg_to_mp3(src: str, dst: str) -> None:
-    subprocess.run(
-        ["ffmpeg", "-y", "-i", src, "-vn", "-acodec", "libmp3lame", "-q:a", "4", dst],
-        check=True,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    )
+# Containers OpenAI transcription accepts as-is; anything else is transcoded to MP3.
+NATIVE_AUDIO_EXTS = frozenset({"ogg", "oga", "opus", "mp3", "m4a", "mp4", "mpeg", "mpga", "wav", "webm", "flac"})
+
+
+_MIME_TO_EXT = {
+    "audio/ogg": "ogg", "audio/opus": "ogg", "audio/mpeg": "mp3", "audio/mp3": "mp3",
+    "audio/mp4": "m4a", "audio/x-m4a": "m4a", "audio/m4a": "m4a", "audio/aac": "m4a",
+    "audio/wav": "wav", "audio/x-wav": "wav", "audio/webm": "webm", "audio/flac": "flac", "audio/x-flac": "flac",
+}
+
+
+def audio_upload_name(file_path: str, is_voice: bool, mime_type: str = "") -> Optional[str]:
+    """Upload filename for audio OpenAI accepts natively, or None if it needs transcoding."""
+    ext = file_path.rsplit(".", 1)[-1].lower() if "." in file_path else ""
+    if ext not in NATIVE_AUDIO_EXTS:
+        ext = _MIME_TO_EXT.get(mime_type.lower(), ext)
+    if is_voice and ext not in NATIVE_AUDIO_EXTS:
+        ext = "ogg"  # Telegram voice notes are always OGG/Opus
+    if ext not in NATIVE_AUDIO_EXTS:
+        return None
+    return f"audio.{'ogg' if ext in ('oga', 'opus') else ext}"
+
+
+# Sample rates the MP3 format allows; anything else (e.g. 96 kHz WAV) is resampled to the nearest one above
+MP3_RATES = (8000, 11025, 12000, 16000, 22050, 24000, 32000, 44100, 48000)
+
+
+def _av_to_mp3(audio: bytes) -> bytes:
+    out = io.BytesIO()
+    with av.open(io.BytesIO(audio)) as src, av.open(out, "w", format="mp3") as dst:
+        in_stream = src.streams.audio[0]
+        rate = next((r for r in MP3_RATES if r >= (in_stream.rate or 44100)), MP3_RATES[-1])
+        layout = "mono" if in_stream.channels == 1 else "stereo"
+        out_stream = dst.add_stream("libmp3lame", rate=rate, layout=layout)
+        resampler = av.AudioResampler(format="s16p", layout=layout, rate=rate)
+
+        def mux(frames) -> None:
+            for frame in frames:
+                for packet in out_stream.encode(frame):
+                    dst.mux(packet)
+
+        for frame in src.decode(in_stream):
+            frame.pts = None
+            mux(resampler.resample(frame))
+        mux(resampler.resample(None))
+        mux([None])
+    return out.getvalue()
+
+
+# Transcoding is CPU-bound: at most one per core, so a voice burst queues instead of thrashing
+_TRANSCODE_SEM = asyncio.Semaphore(os.cpu_count() or 1)
+
+
+@timed
+async def transcode_to_mp3(audio: bytes) -> bytes:
+    """Transcode audio to MP3: PyAV in a worker thread if installed, else (or if PyAV fails) ffmpeg over pipes."""
+    async with _TRANSCODE_SEM:
+        if av is not None:
+            try:
+                return await asyncio.to_thread(_av_to_mp3, audio)
+            except Exception as e:
+                print(f"[TRANSCODE] PyAV failed, falling back to ffmpeg: {e}")
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-i", "pipe:0", "-vn", "-acodec", "libmp3lame", "-q:a", "4", "-f", "mp3", "pipe:1",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        mp3, _ = await proc.communicate(input=audio)
+    if proc.returncode != 0 or not mp3:
+        raise RuntimeError(f"ffmpeg failed (exit {proc.returncode})")
+    return mp3
+
+
+# Transcription cache: forwarded/re-sent voice notes skip the paid OpenAI call.
+# Keys: "fu:{file_unique_id}" (checked before download) and "tx:{blake2b of audio bytes}".
+# Stored in Redis when REDIS_URL is set, else in a bounded in-process cache.
+TRANSCRIPT_TTL_SECONDS = 7 * 86400
+_TRANSCRIPT_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=TRANSCRIPT_TTL_SECONDS)
 
 
-def transcribe(audio_path: str) -> str:
-    with open(audio_path, "rb") as f:
-        res = client.audio.transcriptions.create(
+def audio_digest(audio: bytes) -> str:
+    """Content hash of audio bytes."""
+    return hashlib.blake2b(audio, digest_size=16).hexdigest()
+
+
+async def transcript_cache_get(key: str) -> Optional[str]:
+    if redis_client is None:
+        return _TRANSCRIPT_CACHE.get(key)
+    raw = await redis_client.get(key)
+    return raw.decode("utf-8") if raw else None
+
+
+async def transcript_cache_set(key: str, text: str) -> None:
+    if redis_client is None:
+        _TRANSCRIPT_CACHE[key] = text
+        return
+    await redis_client.set(key, text.encode("utf-8"), ex=TRANSCRIPT_TTL_SECONDS)
+
+
+# Concurrent transcriptions are capped to stay within OpenAI rate limits under voice bursts.
+TRANSCRIBE_CONCURRENCY = 8
+_TRANSCRIBE_SEM = asyncio.Semaphore(TRANSCRIBE_CONCURRENCY)
+
+
+@timed
+async def transcribe(audio: bytes, filename: str) -> str:
+    """Transcribe in-memory audio; filename extension tells OpenAI the container format."""
+    async with _TRANSCRIBE_SEM:
+        res = await client.audio.transcriptions.create(
             model="gpt-4o-transcribe",
-            file=f,
+            file=(filename, audio),
         )
     return (res.text or "").strip()
 
 
 # ===================== GITHUB =====================
-def gh_headers() -> Dict[str, str]:
+def gh_client() -> httpx.AsyncClient:
+    """Shared GitHub client (auth + API headers preset)."""
     if not GITHUB_TOKEN:
         raise RuntimeError("Missing GITHUB_TOKEN")
-    return {
-        "Authorization": f"Bearer {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github+json",
-        "X-GitHub-Api-Version": "2022-11-28",
-    }
+    return GH_HTTP
 
 
+@functools.lru_cache(maxsize=64)
 def gh_repo_parts(repo: Optional[str] = None) -> Tuple[str, str]:
     r = repo or GITHUB_REPO
     if not r or "/" not in r:
@@ -491,29 +1354,60 @@ def gh_repo_parts(repo: Optional[str] = None) -> Tuple[str, str]:
     return owner, name
 
 
-def gh_get_default_branch(repo: Optional[str] = None) -> str:
+# Conditional GETs: GitHub answers 304 (not charged to the rate limit) when the ETag still matches.
+# url → (etag, body); bodies can be whole files (DEVLOG.md), so keep the cache small.
+_GH_ETAG_CACHE: TTLCache = TTLCache(maxsize=128, ttl=86400)
+
+
+async def gh_get_cached(url: str, params: Optional[Dict[str, str]] = None, timeout: float = 30) -> httpx.Response:
+    """GET with If-None-Match; a 304 is turned back into a 200 carrying the cached body."""
+    key = str(httpx.URL(url, params=params))
+    cached = _GH_ETAG_CACHE.get(key)
+    headers = {"If-None-Match": cached[0]} if cached else None
+    r = await gh_client().get(url, params=params, headers=headers, timeout=timeout)
+    if r.status_code == 304 and cached:
+        return httpx.Response(200, content=cached[1], request=r.request)
+    etag = r.headers.get("etag")
+    if r.status_code == 200 and etag:
+        _GH_ETAG_CACHE[key] = (etag, r.content)
+    return r
+
+
+# Default branch rarely changes; keep it for an hour per repo.
+_DEFAULT_BRANCH_CACHE: TTLCache = TTLCache(maxsize=64, ttl=3600)
+
+
+@timed
+async def gh_get_default_branch(repo: Optional[str] = None) -> str:
     owner, name = gh_repo_parts(repo)
-    r = requests.get(f"{GH_API}/repos/{owner}/{name}", headers=gh_headers(), timeout=30)
+    cache_key = f"{owner}/{name}"
+    cached = _DEFAULT_BRANCH_CACHE.get(cache_key)
+    if cached:
+        return cached
+    r = await gh_get_cached(f"{GH_API}/repos/{owner}/{name}")
     r.raise_for_status()
-    return r.json()["default_branch"]
+    branch = orjson.loads(r.content)["default_branch"]
+    _DEFAULT_BRANCH_CACHE[cache_key] = branch
+    return branch
 
 
-def gh_branch_exists(branch: str, repo: Optional[str] = None) -> bool:
+@timed
+async def gh_branch_exists(branch: str, repo: Optional[str] = None) -> bool:
     owner, name = gh_repo_parts(repo)
-    r = requests.get(f"{GH_API}/repos/{owner}/{name}/git/ref/heads/{branch}", headers=gh_headers(), timeout=15)
+    r = await gh_get_cached(f"{GH_API}/repos/{owner}/{name}/git/ref/heads/{branch}", timeout=15)
     return r.status_code == 200
 
 
-def gh_create_branch(branch: str, from_branch: Optional[str] = None, repo: Optional[str] = None) -> str:
+@timed
+async def gh_create_branch(branch: str, from_branch: Optional[str] = None, repo: Optional[str] = None) -> str:
     """Create a new branch from an existing branch. Returns the SHA."""
     owner, name = gh_repo_parts(repo)
     if from_branch is None:
         from_branch = _default_branch(repo)
-    source_sha = gh_get_branch_sha(from_branch, repo=repo)
-    r = requests.post(
+    source_sha = await gh_get_branch_sha(from_branch, repo=repo)
+    r = await gh_client().post(
         f"{GH_API}/repos/{owner}/{name}/git/refs",
-        headers=gh_headers(),
-        json={"ref": f"refs/heads/{branch}", "sha": source_sha},
+        content=orjson.dumps({"ref": f"refs/heads/{branch}", "sha": source_sha}),
         timeout=30,
     )
     if r.status_code >= 300:
@@ -522,25 +1416,26 @@ def gh_create_branch(branch: str, from_branch: Optional[str] = None, repo: Optio
     return source_sha
 
 
-def gh_get_branch_sha(branch: str, repo: Optional[str] = None) -> str:
+@timed
+async def gh_get_branch_sha(branch: str, repo: Optional[str] = None) -> str:
     """Get the latest commit SHA of a branch."""
     owner, name = gh_repo_parts(repo)
-    r = requests.get(f"{GH_API}/repos/{owner}/{name}/git/ref/heads/{branch}", headers=gh_headers(), timeout=15)
+    r = await gh_get_cached(f"{GH_API}/repos/{owner}/{name}/git/ref/heads/{branch}", timeout=15)
     r.raise_for_status()
-    return r.json()["object"]["sha"]
+    return orjson.loads(r.content)["object"]["sha"]
 
 
-def gh_force_reset_branch(branch: str, to_branch: Optional[str] = None, repo: Optional[str] = None) -> str:
+@timed
+async def gh_force_reset_branch(branch: str, to_branch: Optional[str] = None, repo: Optional[str] = None) -> str:
     """Force-update branch to point at the same commit as to_branch.
     Returns the SHA it was reset to."""
     owner, name = gh_repo_parts(repo)
     if to_branch is None:
         to_branch = _default_branch(repo)
-    target_sha = gh_get_branch_sha(to_branch, repo=repo)
-    r = requests.patch(
+    target_sha = await gh_get_branch_sha(to_branch, repo=repo)
+    r = await gh_client().patch(
         f"{GH_API}/repos/{owner}/{name}/git/refs/heads/{branch}",
-        headers=gh_headers(),
-        json={"sha": target_sha, "force": True},
+        content=orjson.dumps({"sha": target_sha, "force": True}),
         timeout=30,
     )
     if r.status_code >= 300:
@@ -548,14 +1443,14 @@ def gh_force_reset_branch(branch: str, to_branch: Optional[str] = None, repo: Op
     return target_sha
 
 
-def gh_create_tag(tag_name: str, sha: str, repo: Optional[str] = None) -> str:
+@timed
+async def gh_create_tag(tag_name: str, sha: str, repo: Optional[str] = None) -> str:
     """Create a lightweight tag pointing at the given SHA.
     Returns the tag name. Silently succeeds if tag already exists."""
     owner, name = gh_repo_parts(repo)
-    r = requests.post(
+    r = await gh_client().post(
         f"{GH_API}/repos/{owner}/{name}/git/refs",
-        headers=gh_headers(),
-        json={"ref": f"refs/tags/{tag_name}", "sha": sha},
+        content=orjson.dumps({"ref": f"refs/tags/{tag_name}", "sha": sha}),
         timeout=30,
     )
     if r.status_code == 422:
@@ -568,78 +1463,91 @@ def gh_create_tag(tag_name: str, sha: str, repo: Optional[str] = None) -> str:
     return tag_name
 
 
-def gh_put_file(branch: str, path: str, content_bytes: bytes, message: str, repo: Optional[str] = None) -> str:
+@timed
+async def gh_put_file(branch: str, path: str, content_bytes: bytes, message: str, repo: Optional[str] = None) -> str:
     owner, name = gh_repo_parts(repo)
-    b64 = base64.b64encode(content_bytes).decode("utf-8")
-    payload: Dict[str, Any] = {"message": message, "content": b64, "branch": branch}
+    # Splice the base64 bytes straight into the JSON body: no str decode of the
+    # encoded image and no re-encode by a JSON serializer (base64 needs no escaping).
+    head = orjson.dumps({"message": message, "branch": branch})[:-1]
+    body = b"".join((head, b',"content":"', base64.b64encode(content_bytes), b'"}'))
 
-    r = requests.put(
+    r = await gh_client().put(
         f"{GH_API}/repos/{owner}/{name}/contents/{path}",
-        headers=gh_headers(),
-        json=payload,
+        content=body,
         timeout=60,
     )
     if r.status_code >= 300:
         raise RuntimeError(f"Upload file failed {r.status_code}: {r.text[:500]}")
 
-    data = r.json()
+    data = orjson.loads(r.content)
     return data["content"]["html_url"]
 
 
-def gh_create_issue(title: str, body: str, extra_labels: Optional[List[str]] = None, repo: Optional[str] = None) -> Dict[str, Any]:
+def git_blob_sha(data: bytes) -> str:
+    """SHA-1 git assigns to a blob with this content."""
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+# "{repo}:{branch}:{blob sha}" → html_url of an already uploaded screenshot.
+# Forgotten when the branch is reset or merged (the file may be gone).
+_SCREENSHOT_URLS: TTLCache = TTLCache(maxsize=256, ttl=86400)
+
+
+def forget_screenshots(repo: str, branch: str) -> None:
+    prefix = f"{repo}:{branch}:"
+    for k in [k for k in _SCREENSHOT_URLS if k.startswith(prefix)]:
+        _SCREENSHOT_URLS.pop(k, None)
+
+
+@timed
+async def gh_create_issue(title: str, body: str, extra_labels: Optional[List[str]] = None, repo: Optional[str] = None) -> Dict[str, Any]:
     owner, name = gh_repo_parts(repo)
     payload: Dict[str, Any] = {"title": title, "body": body}
-    labels = parse_labels()
-    if extra_labels:
-        labels.extend(extra_labels)
+    labels = _LABELS + tuple(extra_labels or ())
     if labels:
         payload["labels"] = labels
 
-    r = requests.post(f"{GH_API}/repos/{owner}/{name}/issues", headers=gh_headers(), json=payload, timeout=30)
+    r = await gh_client().post(f"{GH_API}/repos/{owner}/{name}/issues", content=orjson.dumps(payload), timeout=30)
     if r.status_code >= 300:
         raise RuntimeError(f"Create issue failed {r.status_code}: {r.text[:500]}")
-    return r.json()
+    return orjson.loads(r.content)
 
 
-def gh_update_issue(number: int, body: str, repo: Optional[str] = None) -> None:
+@timed
+async def gh_update_issue(number: int, body: str, repo: Optional[str] = None) -> None:
     owner, name = gh_repo_parts(repo)
-    r = requests.patch(
+    r = await gh_client().patch(
         f"{GH_API}/repos/{owner}/{name}/issues/{number}",
-        headers=gh_headers(),
-        json={"body": body},
+        content=orjson.dumps({"body": body}),
         timeout=30,
     )
     if r.status_code >= 300:
         raise RuntimeError(f"Update issue failed {r.status_code}: {r.text[:500]}")
 
 
-def gh_get_file(branch: str, path: str, repo: Optional[str] = None) -> Optional[Dict[str, str]]:
+@timed
+async def gh_get_file(branch: str, path: str, repo: Optional[str] = None) -> Optional[Dict[str, str]]:
     """Get file content and SHA from GitHub. Returns {"content": str, "sha": str} or None."""
     owner, name = gh_repo_parts(repo)
-    r = requests.get(
-        f"{GH_API}/repos/{owner}/{name}/contents/{path}",
-        headers=gh_headers(),
-        params={"ref": branch},
-        timeout=30,
-    )
+    r = await gh_get_cached(f"{GH_API}/repos/{owner}/{name}/contents/{path}", params={"ref": branch})
     if r.status_code == 404:
         return None
     if r.status_code >= 300:
         print(f"[GH] Get file failed {r.status_code}: {r.text[:200]}")
         return None
-    data = r.json()
+    data = orjson.loads(r.content)
     content = base64.b64decode(data["content"]).decode("utf-8")
     return {"content": content, "sha": data["sha"]}
 
 
-def gh_update_file(branch: str, path: str, content: str, sha: str, message: str, repo: Optional[str] = None) -> bool:
+@timed
+async def gh_update_file(branch: str, path: str, content: str, sha: str, message: str, repo: Optional[str] = None) -> bool:
     """Update existing file on GitHub. Requires current SHA."""
     owner, name = gh_repo_parts(repo)
     b64 = base64.b64encode(content.encode("utf-8")).decode("utf-8")
-    r = requests.put(
+    r = await gh_client().put(
         f"{GH_API}/repos/{owner}/{name}/contents/{path}",
-        headers=gh_headers(),
-        json={"message": message, "content": b64, "branch": branch, "sha": sha},
+        content=orjson.dumps({"message": message, "content": b64, "branch": branch, "sha": sha}),
         timeout=30,
     )
     if r.status_code >= 300:
@@ -648,9 +1556,23 @@ def gh_update_file(branch: str, path: str, content: str, sha: str, message: str,
     return True
 
 
-def gh_mark_devlog_cherry_pick(branch: str, issue_number: int, repo: Optional[str] = None) -> bool:
-    """Mark an issue's entry in DEVLOG.md as cherry-pick candidate."""
-    file_data = gh_get_file(branch, "DEVLOG.md", repo=repo)
+_DEVLOG_STATUS_READY = "**Статус:** ✅ готово к переносу"
+_DEVLOG_STATUS_PICK = "**Статус:** ⭐ забрать в main"
+
+
+def _devlog_status_re(issue_number: Any) -> re.Pattern:
+    """Issue header + the rest of its section up to the ready status line (never crossing the next header)."""
+    return re.compile(
+        rf"(## #{re.escape(str(issue_number))} —(?:(?!## #\d+ —).)*?)" + re.escape(_DEVLOG_STATUS_READY),
+        re.DOTALL,
+    )
+
+
+@timed
+async def gh_mark_devlog_cherry_pick(branch: str, issue_number: int, file_data: Optional[Dict[str, str]],
+                                     repo: Optional[str] = None) -> bool:
+    """Mark an issue's entry in DEVLOG.md as cherry-pick candidate. file_data is DEVLOG.md as returned by
+    gh_get_file, so callers can fetch it alongside other requests."""
     if not file_data:
         print(f"[GH] DEVLOG.md not found on {branch}")
         return False
@@ -664,52 +1586,24 @@ def gh_mark_devlog_cherry_pick(branch: str, issue_number: int, repo: Optional[st
         print(f"[GH] Issue #{issue_number} not found in DEVLOG.md")
         return False
 
-    # Replace status line within this issue's section
-    new_content = content.replace(
-        f"**Статус:** ✅ готово к переносу",
-        f"**Статус:** ⭐ забрать в main",
-        1,  # Only first occurrence after the issue header — but we need to be smarter
-    )
-
-    # More targeted: replace only within the correct issue section
-    # Split by issue headers and find the right section
-    sections = re.split(r'(## #\d+ —)', content)
-    updated = False
-    result_parts = []
-    for i, part in enumerate(sections):
-        if part.strip() == f"## #{issue_number} —" or part.startswith(f"## #{issue_number} — "):
-            # This is the header, next part is the body
-            result_parts.append(part)
-            if i + 1 < len(sections):
-                body = sections[i + 1]
-                body = body.replace(
-                    "**Статус:** ✅ готово к переносу",
-                    "**Статус:** ⭐ забрать в main",
-                    1,
-                )
-                result_parts.append(body)
-                updated = True
-                # Skip the next iteration since we already processed it
-                sections[i + 1] = ""
-        else:
-            result_parts.append(part)
-
-    if not updated:
+    # Replace the status line only within the correct issue section
+    new_content, n = _devlog_status_re(issue_number).subn(
+        lambda m: m.group(1) + _DEVLOG_STATUS_PICK, content, count=1)
+    if not n:
         print(f"[GH] Could not find status line for #{issue_number} in DEVLOG.md")
         return False
 
-    new_content = "".join(result_parts)
-    return gh_update_file(branch, "DEVLOG.md", new_content, sha,
+    return await gh_update_file(branch, "DEVLOG.md", new_content, sha,
                           f"Mark #{issue_number} for cherry-pick to main", repo=repo)
 
 
-def gh_add_label(number: int, label: str, repo: Optional[str] = None) -> bool:
+@timed
+async def gh_add_label(number: int, label: str, repo: Optional[str] = None) -> bool:
     """Add a label to an issue. Creates the label if it doesn't exist. Returns True on success."""
     owner, name = gh_repo_parts(repo)
-    r = requests.post(
+    r = await gh_client().post(
         f"{GH_API}/repos/{owner}/{name}/issues/{number}/labels",
-        headers=gh_headers(),
-        json={"labels": [label]},
+        content=orjson.dumps({"labels": [label]}),
         timeout=30,
     )
     if r.status_code >= 300:
@@ -718,12 +1612,12 @@ def gh_add_label(number: int, label: str, repo: Optional[str] = None) -> bool:
     return True
 
 
-def gh_remove_label(number: int, label: str, repo: Optional[str] = None) -> bool:
+@timed
+async def gh_remove_label(number: int, label: str, repo: Optional[str] = None) -> bool:
     """Remove a label from an issue. Returns True on success."""
     owner, name = gh_repo_parts(repo)
-    r = requests.delete(
+    r = await gh_client().delete(
         f"{GH_API}/repos/{owner}/{name}/issues/{number}/labels/{label}",
-        headers=gh_headers(),
         timeout=30,
     )
     if r.status_code >= 300:
@@ -732,19 +1626,39 @@ def gh_remove_label(number: int, label: str, repo: Optional[str] = None) -> bool
     return True
 
 
-def gh_list_issues_with_labels(labels: List[str], state: str = "open", direction: str = "asc", repo: Optional[str] = None) -> List[Dict[str, Any]]:
+@timed
+async def gh_list_issues_with_labels(labels: List[str], state: str = "open", direction: str = "asc", repo: Optional[str] = None) -> List[Dict[str, Any]]:
     """List issues with ALL specified labels. Returns oldest first by default."""
     owner, name = gh_repo_parts(repo)
-    r = requests.get(
+    r = await gh_client().get(
         f"{GH_API}/repos/{owner}/{name}/issues",
-        headers=gh_headers(),
         params={"labels": ",".join(labels), "state": state, "sort": "created", "direction": direction, "per_page": 20},
         timeout=30,
     )
     if r.status_code >= 300:
         print(f"[GH] List issues failed {r.status_code}: {r.text[:200]}")
         return []
-    return r.json()
+    return orjson.loads(r.content)
+
+
+# ctx → True for dev branches confirmed to exist; dropped on "merged" (branch may get deleted)
+_KNOWN_BRANCHES: TTLCache = TTLCache(maxsize=256, ttl=300)
+
+
+async def ensure_dev_branch(branch: str, from_branch: str, repo: str) -> None:
+    """Create the dev branch from default if it was deleted (e.g. after merge)."""
+    ctx = _ctx_key(repo, branch)
+    if ctx in _KNOWN_BRANCHES:
+        return
+    if await gh_branch_exists(branch, repo=repo):
+        _KNOWN_BRANCHES[ctx] = True
+        return
+    try:
+        await gh_create_branch(branch, from_branch, repo=repo)
+        BRANCH_JUST_CREATED[ctx] = time.time()
+        _KNOWN_BRANCHES[ctx] = True
+    except Exception as e:
+        print(f"[CREATE] Failed to create branch {branch} in {repo}: {e}")
 
 
 def _get_dev_label(branch: str) -> Optional[str]:
@@ -755,13 +1669,15 @@ def _get_dev_label(branch: str) -> Optional[str]:
     return None
 
 
+_WS_RE = re.compile(r"\s+")
+_SENTENCE_END_RE = re.compile(r"[.!?] ")
+
+
 def format_issue(text: str, chat_id: int, user: dict, dev_info: Optional[Dict[str, str]] = None) -> Dict[str, str]:
-    clean = " ".join(text.split()).strip()
-    title = clean
-    for sep in [". ", "! ", "? ", "\n"]:
-        if sep in title:
-            title = title.split(sep, 1)[0]
-            break
+    clean = _WS_RE.sub(" ", text).strip()
+    # Title = first sentence (whitespace is already collapsed, so no newlines remain)
+    m = _SENTENCE_END_RE.search(clean)
+    title = clean[:m.start()] if m else clean
     title = title[:80].strip() or "Voice ticket"
 
     username = user.get("username") or f'{user.get("first_name","")} {user.get("last_name","")}'.strip()
@@ -776,16 +1692,8 @@ def format_issue(text: str, chat_id: int, user: dict, dev_info: Optional[Dict[st
 
 
 # ===================== UI / FLOW =====================
-def show_apps_menu(chat_id: int, reply_to_message_id: Optional[int] = None, in_group: bool = False) -> None:
-    """Send keyboard with WebApp buttons for all Netlify sites. Falls back to legacy WEBAPP_URL_DEV_* env vars."""
-    print(f"[APPS] show_apps_menu called for chat={chat_id} in_group={in_group}")
-
-    if in_group:
-        tg_send_message(chat_id,
-            "WebApp кнопки работают только в личке. Напиши мне /apps в личные сообщения.",
-            reply_to_message_id=reply_to_message_id)
-        return
-
+def _build_apps_keyboard() -> List[List[Dict[str, Any]]]:
+    """WebApp buttons for all Netlify sites; falls back to legacy WEBAPP_URL_DEV_* env vars."""
     keyboard_inline: List[List[Dict[str, Any]]] = []
 
     # Build from NETLIFY_SITE_MAP (primary source)
@@ -809,16 +1717,32 @@ def show_apps_menu(chat_id: int, reply_to_message_id: Optional[int] = None, in_g
             keyboard_inline.append([{"text": f"🔵 Тест — {WEBAPP_DEV_1_NAME}", "web_app": {"url": WEBAPP_URL_DEV_1}}])
         if WEBAPP_URL_DEV_2:
             keyboard_inline.append([{"text": f"🟡 Тест — {WEBAPP_DEV_2_NAME}", "web_app": {"url": WEBAPP_URL_DEV_2}}])
+    return keyboard_inline
 
-    if not keyboard_inline:
-        tg_send_message(chat_id, "Приложения не настроены. Задайте NETLIFY_SITE_MAP в env.", reply_to_message_id=reply_to_message_id)
+
+# Inputs are env-derived, so the keyboard is fixed for the process lifetime
+APPS_KEYBOARD = _build_apps_keyboard()
+
+
+async def show_apps_menu(chat_id: int, reply_to_message_id: Optional[int] = None, in_group: bool = False) -> None:
+    """Send keyboard with WebApp buttons for all Netlify sites."""
+    print(f"[APPS] show_apps_menu called for chat={chat_id} in_group={in_group}")
+
+    if in_group:
+        await tg_send_message(chat_id,
+            "WebApp кнопки работают только в личке. Напиши мне /apps в личные сообщения.",
+            reply_to_message_id=reply_to_message_id)
+        return
+
+    if not APPS_KEYBOARD:
+        await tg_send_message(chat_id, "Приложения не настроены. Задайте NETLIFY_SITE_MAP в env.", reply_to_message_id=reply_to_message_id)
         return
 
-    print(f"[APPS] Sending InlineKeyboard with {len(keyboard_inline)} buttons")
-    resp = tg_send_message_with_keyboard(
+    print(f"[APPS] Sending InlineKeyboard with {len(APPS_KEYBOARD)} buttons")
+    resp = await tg_send_message_with_keyboard(
         chat_id,
         "Тестовые приложения:",
-        keyboard_inline,
+        APPS_KEYBOARD,
         reply_to_message_id=reply_to_message_id,
     )
     print(f"[APPS] TG response ok={resp.get('ok') if resp else 'None'}")
@@ -827,7 +1751,6 @@ def show_apps_menu(chat_id: int, reply_to_message_id: Optional[int] = None, in_g
 def confirmation_text(state: Dict[str, Any]) -> str:
     screenshot = state.get("screenshot")
     dev_info = state.get("dev_info")
-    opts = state.get("options", DEFAULT_OPTIONS)
     repo = state.get("repo")
 
     meta = []
@@ -839,39 +1762,43 @@ def confirmation_text(state: Dict[str, Any]) -> str:
     else:
         meta.append("Ветка: default (разработчик не привязан)")
 
-    # Option toggles display
-    opt_parts = []
-    opt_parts.append(f"{'✅' if opts.get('multi_agent') else '—'} мультиагент")
-    opt_parts.append(f"{'✅' if opts.get('testing') else '—'} тесты")
-    opt_parts.append(f"{'✅' if opts.get('approve_plan') else '—'} апрув плана")
-
+    # CI options are shown only on the toggle buttons, so a toggle edits just the keyboard
     return (
         "Вот что я распознал:\n\n"
         + f"\u201c{state['text']}\u201d\n\n"
         + " | ".join(meta)
-        + f"\nCI: {' | '.join(opt_parts)}"
         + "\n\nЧто делаем?"
     )
 
 
-def confirmation_keyboard(author_id: int, state: Dict[str, Any]) -> List[List[Dict[str, str]]]:
-    opts = state.get("options", DEFAULT_OPTIONS)
-    rows = [
+@functools.lru_cache(maxsize=1024)
+def _confirmation_rows(author_id: int, multi_agent: bool, testing: bool, approve_plan: bool) -> List[List[Dict[str, str]]]:
+    # Shared cached object — callers only serialize it, never mutate
+    return [
         [{"text": "✅ Создать issue", "callback_data": f"create:{author_id}"}],
         [
-            {"text": f"{'🤖' if opts.get('multi_agent') else '⬜'} Мультиагент", "callback_data": f"opt_ma:{author_id}"},
-            {"text": f"{'🧪' if opts.get('testing') else '⬜'} Тесты", "callback_data": f"opt_test:{author_id}"},
-            {"text": f"{'📋' if opts.get('approve_plan') else '⬜'} Апрув", "callback_data": f"opt_appr:{author_id}"},
+            {"text": f"{'🤖' if multi_agent else '⬜'} Мультиагент", "callback_data": f"opt_ma:{author_id}"},
+            {"text": f"{'🧪' if testing else '⬜'} Тесты", "callback_data": f"opt_test:{author_id}"},
+            {"text": f"{'📋' if approve_plan else '⬜'} Апрув", "callback_data": f"opt_appr:{author_id}"},
         ],
+        [{"text": "✏️ Правка текста", "callback_data": f"edit:{author_id}"}, {"text": "📎 скриншот", "callback_data": f"shot:{author_id}"}],
+        [{"text": "❌ Отмена", "callback_data": f"cancel:{author_id}"}],
     ]
-    rows.append([{"text": "✏️ Правка текста", "callback_data": f"edit:{author_id}"}, {"text": "📎 скриншот", "callback_data": f"shot:{author_id}"}])
-    rows.append([{"text": "❌ Отмена", "callback_data": f"cancel:{author_id}"}])
-    return rows
 
 
-def show_confirmation(chat_id: int, author_id: int, state: Dict[str, Any], reply_to_message_id: Optional[int] = None) -> None:
+def confirmation_keyboard(author_id: int, state: Dict[str, Any]) -> List[List[Dict[str, str]]]:
+    opts = state.get("options", DEFAULT_OPTIONS)
+    return _confirmation_rows(
+        author_id,
+        bool(opts.get("multi_agent")),
+        bool(opts.get("testing")),
+        bool(opts.get("approve_plan")),
+    )
+
+
+async def show_confirmation(chat_id: int, author_id: int, state: Dict[str, Any], reply_to_message_id: Optional[int] = None) -> None:
     keyboard = confirmation_keyboard(author_id, state)
-    resp = tg_send_message_with_keyboard(chat_id, confirmation_text(state), keyboard, reply_to_message_id=reply_to_message_id)
+    resp = await tg_send_message_with_keyboard(chat_id, confirmation_text(state), keyboard, reply_to_message_id=reply_to_message_id)
     # Store message_id for later editing (toggle buttons)
     if resp and resp.get("ok"):
         state["confirmation_message_id"] = resp["result"]["message_id"]
@@ -899,87 +1826,94 @@ def extract_image_from_message(msg: dict) -> Optional[Dict[str, Any]]:
 # Bot controls execution order by swapping labels one at a time.
 
 
-def queue_is_busy(repo: str, branch: str) -> bool:
-    """Check if (repo, branch) has active ticket. In-memory with GitHub API fallback (handles bot restart)."""
+async def queue_active(repo: str, branch: str) -> Optional[Dict[str, Any]]:
+    """Active ticket of (repo, branch). State store with GitHub API fallback (handles bot restart)."""
     ctx = _ctx_key(repo, branch)
-    if ACTIVE_TICKET.get(ctx) is not None:
-        return True
+    active = await state_get("active", ctx)
+    if active is not None:
+        return active
     # Fallback: check GitHub for issue with queue:execute label
     dev_label = _get_dev_label(branch)
     if not dev_label:
-        return False
+        return None
     try:
-        active_issues = gh_list_issues_with_labels(["queue:execute", dev_label], repo=repo)
+        active_issues = await gh_list_issues_with_labels(["queue:execute", dev_label], repo=repo)
         if active_issues:
             issue = active_issues[0]
-            queue_set_active(repo, branch, issue["number"], issue["title"])
+            await queue_set_active(repo, branch, issue["number"], issue["title"])
             print(f"[QUEUE] Recovered active ticket from GitHub: #{issue['number']} ({repo})")
-            return True
+            return await state_get("active", ctx)
     except Exception as e:
         print(f"[QUEUE] GitHub fallback check failed: {e}")
-    return False
+    return None
+
 
+async def queue_is_busy(repo: str, branch: str) -> bool:
+    """Check if (repo, branch) has active ticket."""
+    return await queue_active(repo, branch) is not None
 
-def queue_size(repo: str, branch: str) -> int:
+
+async def queue_size(repo: str, branch: str) -> int:
     """Get count of pending tickets for (repo, branch) from GitHub Issues."""
     dev_label = _get_dev_label(branch)
     if not dev_label:
         return 0
     try:
-        pending = gh_list_issues_with_labels(["queue:pending", dev_label], repo=repo)
+        pending = await gh_list_issues_with_labels(["queue:pending", dev_label], repo=repo)
         return len(pending)
     except Exception:
         return 0
 
 
-def queue_list_pending(repo: str, branch: str) -> List[Dict[str, Any]]:
+async def queue_list_pending(repo: str, branch: str) -> List[Dict[str, Any]]:
     """List pending tickets for (repo, branch) from GitHub Issues (oldest first)."""
     dev_label = _get_dev_label(branch)
     if not dev_label:
         return []
     try:
-        return gh_list_issues_with_labels(["queue:pending", dev_label], repo=repo)
+        return await gh_list_issues_with_labels(["queue:pending", dev_label], repo=repo)
     except Exception:
         return []
 
 
-def queue_set_active(repo: str, branch: str, issue_number: int, title: str) -> None:
-    """Mark ticket as active (in-memory tracking for /status)."""
+async def queue_set_active(repo: str, branch: str, issue_number: int, title: str) -> None:
+    """Mark ticket as active (state tracking for /status)."""
     ctx = _ctx_key(repo, branch)
-    ACTIVE_TICKET[ctx] = {"issue_number": issue_number, "title": title}
-    CI_PROGRESS[ctx] = {
-        "started_at": now_ts(),
+    await state_set("active", ctx, {"issue_number": issue_number, "title": title, "title_html": html_escape(title)})
+    now = now_ts()
+    await ci_progress_save(ctx, {
+        "started_at": now,
         "last_phase": "Запуск",
         "last_message": "",
-        "last_update_at": now_ts(),
+        "last_update_at": now,
         # Phase tracking for /status step-by-step display
         "options": {},  # {multi_agent, testing, approve} — set by claude_started
-        "phases_done": [],  # list of phase_num strings already completed
+        "phases_done": {},  # phase_num → finished_at, insertion-ordered
         "current_phase_num": "",  # e.g. "3"
-    }
+    })
 
 
-def queue_clear_active(repo: str, branch: str) -> None:
+async def queue_clear_active(repo: str, branch: str) -> None:
     """Clear active ticket. Removes queue:execute label so recovery doesn't find it."""
     ctx = _ctx_key(repo, branch)
-    active = ACTIVE_TICKET.get(ctx)
+    active = await state_get("active", ctx)
     if active:
         try:
-            gh_remove_label(active["issue_number"], "queue:execute", repo=repo)
+            await gh_remove_label(active["issue_number"], "queue:execute", repo=repo)
         except Exception as e:
             print(f"[QUEUE] Failed to remove queue:execute from #{active['issue_number']}: {e}")
-    ACTIVE_TICKET[ctx] = None
-    CI_PROGRESS.pop(ctx, None)
+    await state_pop("active", ctx)
+    await ci_progress_save(ctx, None)
 
 
-def queue_process_next(repo: str, branch: str) -> Optional[Dict[str, Any]]:
+async def queue_process_next(repo: str, branch: str) -> Optional[Dict[str, Any]]:
     """Activate next pending ticket by swapping labels. Triggers CI via labeled event."""
     ctx = _ctx_key(repo, branch)
     dev_label = _get_dev_label(branch)
     if not dev_label:
         return None
     try:
-        pending = gh_list_issues_with_labels(["queue:pending", dev_label], repo=repo)
+        pending = await gh_list_issues_with_labels(["queue:pending", dev_label], repo=repo)
         if not pending:
             return None
 
@@ -988,22 +1922,22 @@ def queue_process_next(repo: str, branch: str) -> Optional[Dict[str, Any]]:
         issue_title = issue["title"]
 
         # Swap labels: remove pending, add execute (triggers CI)
-        gh_remove_label(issue_number, "queue:pending", repo=repo)
-        ok = gh_add_label(issue_number, "queue:execute", repo=repo)
+        await gh_remove_label(issue_number, "queue:pending", repo=repo)
+        ok = await gh_add_label(issue_number, "queue:execute", repo=repo)
         if not ok:
             print(f"[QUEUE] Failed to add queue:execute to #{issue_number}")
             return None
 
-        # Mark as active in memory
-        queue_set_active(repo, branch, issue_number, issue_title)
+        # Mark as active
+        await queue_set_active(repo, branch, issue_number, issue_title)
 
         # Notify developer
-        dev_ctx = DEV_CHAT.get(ctx)
+        dev_ctx = await state_get("dev_chat", ctx)
         if dev_ctx:
             remaining = len(pending) - 1
             queue_info = f"\n📋 В очереди ещё: {remaining}" if remaining > 0 else ""
             repo_tag = f" [{_repo_short(repo)}]"
-            tg_send_html(dev_ctx["chat_id"],
+            await tg_send_html(dev_ctx["chat_id"],
                 f"▶️ Следующий тикет{repo_tag}: <a href=\"{issue['html_url']}\">#{issue_number}</a>\n"
                 f"{html_escape(issue_title)}{queue_info}")
 
@@ -1014,6 +1948,22 @@ def queue_process_next(repo: str, branch: str) -> Optional[Dict[str, Any]]:
 
 
 # ===================== ROUTES =====================
+async def read_json(req: Request) -> Any:
+    """Parse the request body with orjson (Starlette's req.json() goes through stdlib json)."""
+    return orjson.loads(await req.body())
+
+
+async def notify_signature_ok(req: Request) -> bool:
+    """Verify X-Bot-Secret on workflow callbacks; always True when NOTIFY_SECRET isn't configured."""
+    if not NOTIFY_SECRET:
+        return True
+    expected = hmac.new(NOTIFY_SECRET, await req.body(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, req.headers.get("x-bot-secret", ""))
+
+
+_BAD_SIGNATURE = {"ok": False, "error": "bad signature"}
+
+
 @app.get("/")
 def health():
     uptime = int(time.time()) - BOT_STARTED_AT
@@ -1025,11 +1975,24 @@ def health():
     }
 
 
+# Telegram HTML per /github/notify event; every field is already escaped by the caller
+_GH_NOTIFY_TEMPLATES = MappingProxyType({
+    "claude_started": "🤖 Claude начал работу%(repo_tag)s\n\n#%(num)s (%(name)s): %(title)s\nВетка: %(branch)s",
+    "phase": "🔄 <b>Фаза %(phase_num)s</b>: %(phase)s\n#%(num)s: %(title)s",
+    "opus_unavailable": "⚠️ Opus недоступен, переключаюсь на Sonnet\n\n#%(num)s (%(name)s): %(title)s",
+    "claude_failed": "❌ Claude упал при работе над <b>#%(num)s</b> (%(name)s): %(title)s\nПопробуй создать тикет ещё раз.",
+    "merged": "📦 Задача завершена%(repo_tag)s — %(branch)s\n\n#%(num)s (%(name)s): %(title)s\n\n⏳ Ждём билд...",
+})
+
+
 @app.post("/github/notify")
 async def github_notify(req: Request):
     """Receive notifications from GitHub Actions workflow."""
+    if not await notify_signature_ok(req):
+        print("[AUTH] Rejected /github/notify: bad X-Bot-Secret")
+        return ORJSONResponse(_BAD_SIGNATURE, status_code=401)
     try:
-        payload = await req.json()
+        payload = await read_json(req)
     except Exception:
         return {"ok": False, "error": "invalid json"}
 
@@ -1042,82 +2005,72 @@ async def github_notify(req: Request):
 
     print(f"[GH_NOTIFY] event={event} branch={branch} repo={repo} issue=#{issue_number}")
 
-    dev_ctx = DEV_CHAT.get(ctx)
+    dev_ctx = await state_get("dev_chat", ctx)
     if not dev_ctx:
         # Fallback: recover from DEVELOPER_MAP after bot restart
         fallback_uid = _BRANCH_TO_DEV.get(branch)
         if fallback_uid:
-            dev_ctx = {"chat_id": fallback_uid, "user_id": fallback_uid, "first_name": "Dev"}
-            DEV_CHAT[ctx] = dev_ctx
+            dev_ctx = {"chat_id": fallback_uid, "user_id": fallback_uid, "first_name": "Dev", "first_name_html": "Dev",
+                       "updated_at": now_ts()}
+            await state_set("dev_chat", ctx, dev_ctx)
             print(f"[GH_NOTIFY] Recovered DEV_CHAT for {ctx} from DEVELOPER_MAP (uid={fallback_uid})")
         else:
-            print(f"[GH_NOTIFY] No chat for {ctx}, DEV_CHAT keys={list(DEV_CHAT.keys())}")
+            print(f"[GH_NOTIFY] No chat for {ctx}, DEV_CHAT keys={list(await state_all('dev_chat'))}")
             return {"ok": True, "skipped": "no chat"}
 
     chat_id = dev_ctx["chat_id"]
-    mention = tg_mention(dev_ctx["user_id"], dev_ctx["first_name"])
     repo_tag = f" [{_repo_short(repo)}]" 
-    safe_title = html_escape(issue_title)
-    safe_branch = html_escape(branch)
+    # Reuse the title escaped when the ticket became active (every lifecycle event repeats it)
+    active = await state_get("active", ctx)
+    if active and active.get("title") == issue_title and "title_html" in active:
+        safe_title = active["title_html"]
+    else:
+        safe_title = html_escape(issue_title)
+    fields = {"repo_tag": repo_tag, "num": issue_number, "name": dev_name_html(dev_ctx),
+              "title": safe_title, "branch": html_escape(branch)}
 
     if event == "claude_started":
         # Mark as active (helps recover queue state after bot restart)
-        queue_set_active(repo, branch, int(issue_number), issue_title)
+        await queue_set_active(repo, branch, int(issue_number), issue_title)
 
         # Store CI options for /status step display
         options = payload.get("options", {})
-        if ctx in CI_PROGRESS and options:
-            CI_PROGRESS[ctx]["options"] = options
+        if options:
+            await ci_progress_update(ctx, options=options)
 
-        tg_send_html(chat_id,
-            f"🤖 Claude начал работу{repo_tag}\n\n"
-            f"#{issue_number} ({html_escape(dev_ctx['first_name'])}): {safe_title}\n"
-            f"Ветка: {safe_branch}")
+        await tg_notify(chat_id, _GH_NOTIFY_TEMPLATES[event] % fields)
     elif event == "phase":
         phase_name = payload.get("phase", "")
         phase_num = payload.get("phase_num", "")
         silent = payload.get("silent", False)
 
         # Always update CI progress (for /status)
-        if ctx in CI_PROGRESS:
-            # Mark previous phase as done when new phase starts
-            prev = CI_PROGRESS[ctx].get("current_phase_num", "")
-            if prev and prev != phase_num:
-                done_list = CI_PROGRESS[ctx].get("phases_done", [])
-                if prev not in done_list:
-                    done_list.append(prev)
-                CI_PROGRESS[ctx]["phases_done"] = done_list
-            CI_PROGRESS[ctx]["current_phase_num"] = phase_num
-            CI_PROGRESS[ctx]["last_phase"] = phase_name
-            CI_PROGRESS[ctx]["last_update_at"] = now_ts()
+        await ci_progress_enter_phase(ctx, phase_num, phase_name)
 
         # Send TG notification unless silent (tracking-only)
         if not silent:
-            safe_phase = html_escape(phase_name)
-            tg_send_html(chat_id,
-                f"🔄 <b>Фаза {phase_num}</b>: {safe_phase}\n"
-                f"#{issue_number}: {safe_title}")
+            fields.update(phase_num=phase_num, phase=html_escape(phase_name))
+            await tg_notify(chat_id, _GH_NOTIFY_TEMPLATES[event] % fields)
     elif event == "opus_unavailable":
-        tg_send_html(chat_id,
-            f"⚠️ Opus недоступен, переключаюсь на Sonnet\n\n"
-            f"#{issue_number} ({html_escape(dev_ctx['first_name'])}): {safe_title}")
+        await tg_notify(chat_id, _GH_NOTIFY_TEMPLATES[event] % fields)
     elif event == "claude_failed":
         LAST_DEPLOY_URL.pop(ctx, None)  # Clear stale deploy URL
-        tg_send_html(chat_id,
-            f"❌ Claude упал при работе над <b>#{issue_number}</b> ({html_escape(dev_ctx['first_name'])}): {safe_title}\n"
-            f"Попробуй создать тикет ещё раз.")
+        await tg_notify(chat_id, _GH_NOTIFY_TEMPLATES[event] % fields)
         # Clear active and process queue
-        queue_clear_active(repo, branch)
-        queue_process_next(repo, branch)
+        await queue_clear_active(repo, branch)
+        await queue_process_next(repo, branch)
     elif event == "merged":
         # Deduplicate: if already completed within 30s, skip duplicate "merged" event
+        now = time.time()
         prev_completed = RECENTLY_COMPLETED.get(ctx, 0)
-        if prev_completed and (time.time() - prev_completed) < 30:
-            print(f"[GH_NOTIFY] Duplicate merged for {ctx}, skipping (prev {time.time() - prev_completed:.0f}s ago)")
+        if prev_completed and (now - prev_completed) < 30:
+            print(f"[GH_NOTIFY] Duplicate merged for {ctx}, skipping (prev {now - prev_completed:.0f}s ago)")
             return {"ok": True, "skipped": "duplicate_merged"}
 
         # Mark as recently completed (grace period for post-merge Netlify deploys)
-        RECENTLY_COMPLETED[ctx] = time.time()
+        RECENTLY_COMPLETED[ctx] = now
+        _KNOWN_BRANCHES.pop(ctx, None)  # re-check existence on next create
+        forget_screenshots(repo, branch)
 
         # Always show "waiting for build" — the final commit was JUST pushed,
         # so any cached LAST_DEPLOY_URL is from a previous (stale) deploy.
@@ -1125,14 +2078,11 @@ async def github_notify(req: Request):
         LAST_DEPLOY_URL.pop(ctx, None)  # clear stale URL
         version = payload.get("version", "")
 
-        text = (
-            f"📦 Задача завершена{repo_tag} — {safe_branch}\n\n"
-            f"#{issue_number} ({html_escape(dev_ctx['first_name'])}): {safe_title}"
-            f"\n\n⏳ Ждём билд...")
+        text = _GH_NOTIFY_TEMPLATES[event] % fields
 
         # Send with "cherry-pick to main" button
         keyboard = [[{"text": "⭐ Забрать в main", "callback_data": f"pick:{repo}:{issue_number}"}]]
-        resp = tg_send_message_with_keyboard(chat_id, text, keyboard, parse_mode="HTML")
+        resp = await tg_send_message_with_keyboard(chat_id, text, keyboard, parse_mode="HTML")
 
         # Save context for Netlify webhook to send deploy link as separate message
         RECENTLY_MERGED[ctx] = {
@@ -1140,12 +2090,12 @@ async def github_notify(req: Request):
             "issue_number": issue_number,
             "repo": repo,
             "version": version,
-            "ts": time.time(),
+            "ts": now,
         }
 
         # Clear active and process queue
-        queue_clear_active(repo, branch)
-        queue_process_next(repo, branch)
+        await queue_clear_active(repo, branch)
+        await queue_process_next(repo, branch)
     else:
         print(f"[GH_NOTIFY] Unknown event={event}")
         return {"ok": True, "skipped": "unknown event"}
@@ -1153,11 +2103,42 @@ async def github_notify(req: Request):
     return {"ok": True, "notified": True}
 
 
+_PHASE_PREFIX_RE = re.compile(r'^Phase \d+[a-z]?\s*[—–\-]\s*')
+_PHASE_UPDATE_TYPES = {
+    "test_pass": "Тесты OK", "test_fail": "Тесты упали",
+    "perf_pass": "Перфоманс OK", "perf_fail": "Перфоманс регрессия",
+    "done": "Завершено", "error": "Ошибка",
+}
+# Literal "\\n" sequences are replaced first, real newlines via one translate pass
+_NEWLINE_TO_SPACE = str.maketrans({"\n": " "})
+MAX_MSG_LEN = 3500
+
+# Emoji and header by message type
+TYPE_CONFIG = {
+    "plan":          {"emoji": "📋", "header": "План"},
+    "progress":      {"emoji": "⏳", "header": "Прогресс"},
+    "question":      {"emoji": "❓", "header": "Вопрос"},
+    "done":          {"emoji": "✅", "header": "Готово"},
+    "error":         {"emoji": "⚠️", "header": "Ошибка"},
+    "info":          {"emoji": "💬", "header": ""},
+    # Multi-agent workflow types
+    "codex_review":  {"emoji": "🔍", "header": "Codex Review"},
+    "phase":         {"emoji": "🔄", "header": "Фаза"},
+    "test_pass":     {"emoji": "✅", "header": "Тесты пройдены"},
+    "test_fail":     {"emoji": "❌", "header": "Тесты упали"},
+    "perf_pass":     {"emoji": "⚡", "header": "Перфоманс ОК"},
+    "perf_fail":     {"emoji": "🐌", "header": "Перфоманс регрессия"},
+}
+
+
 @app.post("/claude/message")
 async def claude_message(req: Request):
     """Receive messages from Claude during work — plans, progress, questions, reviews, tests."""
+    if not await notify_signature_ok(req):
+        print("[AUTH] Rejected /claude/message: bad X-Bot-Secret")
+        return ORJSONResponse(_BAD_SIGNATURE, status_code=401)
     try:
-        payload = await req.json()
+        payload = await read_json(req)
     except Exception:
         return {"ok": False, "error": "invalid json"}
 
@@ -1173,33 +2154,29 @@ async def claude_message(req: Request):
     print(f"[CLAUDE_MSG] text={text[:200]}")
 
     # Track CI progress for /status command
-    if branch and ctx in CI_PROGRESS:
+    if branch:
+        fields: Dict[str, Any] = {}
         # Update phase label only for definitive events (phases tracked via /github/notify)
-        phase_update_types = {
-            "test_pass": "Тесты OK", "test_fail": "Тесты упали",
-            "perf_pass": "Перфоманс OK", "perf_fail": "Перфоманс регрессия",
-            "done": "Завершено", "error": "Ошибка",
-        }
-        if message_type in phase_update_types:
-            CI_PROGRESS[ctx]["last_phase"] = phase_update_types[message_type]
+        if message_type in _PHASE_UPDATE_TYPES:
+            fields["last_phase"] = _PHASE_UPDATE_TYPES[message_type]
 
         # Clean up message for /status display
-        clean_msg = text.replace('\\n', ' ').replace('\n', ' ').strip()
+        clean_msg = text.replace('\\n', ' ').translate(_NEWLINE_TO_SPACE).strip()
         # Strip "Phase N — " prefix (phase tracked separately)
-        clean_msg = re.sub(r'^Phase \d+[a-z]?\s*[—–\-]\s*', '', clean_msg)
+        clean_msg = _PHASE_PREFIX_RE.sub('', clean_msg, count=1)
         # Skip raw JSON (useless in status)
         stripped = clean_msg.lstrip()
         if stripped.startswith('[') or stripped.startswith('{'):
             clean_msg = ""
-        CI_PROGRESS[ctx]["last_message"] = clean_msg[:150]
-        CI_PROGRESS[ctx]["last_update_at"] = now_ts()
+        await ci_progress_update(ctx, last_message=clean_msg[:150], last_update_at=now_ts(), **fields)
 
-    dev_ctx = DEV_CHAT.get(ctx)
+    dev_ctx = await state_get("dev_chat", ctx)
     if not dev_ctx:
         fallback_uid = _BRANCH_TO_DEV.get(branch)
         if fallback_uid:
-            dev_ctx = {"chat_id": fallback_uid, "user_id": fallback_uid, "first_name": "Dev"}
-            DEV_CHAT[ctx] = dev_ctx
+            dev_ctx = {"chat_id": fallback_uid, "user_id": fallback_uid, "first_name": "Dev", "first_name_html": "Dev",
+                       "updated_at": now_ts()}
+            await state_set("dev_chat", ctx, dev_ctx)
             print(f"[CLAUDE_MSG] Recovered DEV_CHAT for {ctx} from DEVELOPER_MAP (uid={fallback_uid})")
         else:
             print(f"[CLAUDE_MSG] No chat for {ctx}")
@@ -1209,34 +2186,16 @@ async def claude_message(req: Request):
     safe_text = html_escape(text)
 
     # Truncate very long messages (Codex reviews, test output)
-    MAX_MSG_LEN = 3500
     if len(safe_text) > MAX_MSG_LEN:
         safe_text = safe_text[:MAX_MSG_LEN] + "\n\n<i>… (обрезано)</i>"
 
-    # Emoji and header by message type
-    TYPE_CONFIG = {
-        "plan":          {"emoji": "📋", "header": "План"},
-        "progress":      {"emoji": "⏳", "header": "Прогресс"},
-        "question":      {"emoji": "❓", "header": "Вопрос"},
-        "done":          {"emoji": "✅", "header": "Готово"},
-        "error":         {"emoji": "⚠️", "header": "Ошибка"},
-        "info":          {"emoji": "💬", "header": ""},
-        # Multi-agent workflow types
-        "codex_review":  {"emoji": "🔍", "header": "Codex Review"},
-        "phase":         {"emoji": "🔄", "header": "Фаза"},
-        "test_pass":     {"emoji": "✅", "header": "Тесты пройдены"},
-        "test_fail":     {"emoji": "❌", "header": "Тесты упали"},
-        "perf_pass":     {"emoji": "⚡", "header": "Перфоманс ОК"},
-        "perf_fail":     {"emoji": "🐌", "header": "Перфоманс регрессия"},
-    }
-
     # Remap "done" from Claude → "progress" — real completion is /github/notify "merged" event.
     # Claude sends "done" after Phase 3 (implementation), but code review & tests still follow.
     display_type = message_type
     if display_type == "done":
         display_type = "progress"
 
-    config = TYPE_CONFIG.get(display_type, {"emoji": "💬", "header": ""})
+    config = TYPE_CONFIG.get(display_type, TYPE_CONFIG["info"])
     emoji = config["emoji"]
     header = config["header"]
 
@@ -1250,10 +2209,10 @@ async def claude_message(req: Request):
         full_header = header
 
     if full_header:
-        tg_send_html(chat_id,
+        await tg_notify(chat_id,
             f"{emoji} <b>{full_header}</b> — #{issue_number}\n\n{safe_text}")
     else:
-        tg_send_html(chat_id,
+        await tg_notify(chat_id,
             f"{emoji} <b>Claude #{issue_number}</b>\n\n{safe_text}")
 
     return {"ok": True, "sent": True}
@@ -1263,8 +2222,11 @@ async def claude_message(req: Request):
 @app.post("/ci/request-approval")
 async def ci_request_approval(req: Request):
     """Called by workflow after Phase 1+2 to request developer approval of the plan."""
+    if not await notify_signature_ok(req):
+        print("[AUTH] Rejected /ci/request-approval: bad X-Bot-Secret")
+        return ORJSONResponse(_BAD_SIGNATURE, status_code=401)
     try:
-        payload = await req.json()
+        payload = await read_json(req)
     except Exception:
         return {"ok": False, "error": "invalid json"}
 
@@ -1275,32 +2237,24 @@ async def ci_request_approval(req: Request):
     ctx = _ctx_key(repo, branch)
 
     approval_key = f"{repo}:{branch}:{issue_number}"
-    APPROVAL_REQUESTS[approval_key] = {"status": "pending", "feedback": None}
+    await approval_set(approval_key, "pending")
 
     print(f"[APPROVAL] Requested: {approval_key}")
 
     # Track approval gate as phase "A" for /status
-    if ctx in CI_PROGRESS:
-        prev = CI_PROGRESS[ctx].get("current_phase_num", "")
-        if prev and prev != "A":
-            done_list = CI_PROGRESS[ctx].get("phases_done", [])
-            if prev not in done_list:
-                done_list.append(prev)
-            CI_PROGRESS[ctx]["phases_done"] = done_list
-        CI_PROGRESS[ctx]["current_phase_num"] = "A"
-        CI_PROGRESS[ctx]["last_phase"] = "Ожидание апрува"
-        CI_PROGRESS[ctx]["last_update_at"] = now_ts()
-
-    dev_ctx = DEV_CHAT.get(ctx)
+    await ci_progress_enter_phase(ctx, "A", "Ожидание апрува")
+
+    dev_ctx = await state_get("dev_chat", ctx)
     if not dev_ctx:
         fallback_uid = _BRANCH_TO_DEV.get(branch)
         if fallback_uid:
-            dev_ctx = {"chat_id": fallback_uid, "user_id": fallback_uid, "first_name": "Dev"}
-            DEV_CHAT[ctx] = dev_ctx
+            dev_ctx = {"chat_id": fallback_uid, "user_id": fallback_uid, "first_name": "Dev", "first_name_html": "Dev",
+                       "updated_at": now_ts()}
+            await state_set("dev_chat", ctx, dev_ctx)
             print(f"[APPROVAL] Recovered DEV_CHAT for {ctx} from DEVELOPER_MAP (uid={fallback_uid})")
         else:
             print(f"[APPROVAL] No chat for {ctx} — auto-approving")
-            APPROVAL_REQUESTS[approval_key] = {"status": "approved", "feedback": None}
+            await approval_set(approval_key, "approved")
             return {"ok": True, "auto_approved": True}
 
     chat_id = dev_ctx["chat_id"]
@@ -1314,7 +2268,7 @@ async def ci_request_approval(req: Request):
         ],
     ]
 
-    tg_send_message_with_keyboard(
+    await tg_send_message_with_keyboard(
         chat_id,
         f"📋 Апрув плана — #{issue_number}\n\n"
         f"{safe_plan}\n\n"
@@ -1333,19 +2287,15 @@ async def ci_check_approval(req: Request):
     issue_number = req.query_params.get("issue_number", "")
 
     approval_key = f"{repo}:{branch}:{issue_number}"
-    entry = APPROVAL_REQUESTS.get(approval_key)
+    entry = await state_get("approval", approval_key)
 
     if not entry:
         print(f"[APPROVAL] Check: {approval_key} → not_found")
         return {"ok": True, "status": "not_found"}
 
-    # Support both old string format and new dict format
-    if isinstance(entry, str):
-        status = entry
-        feedback = None
-    else:
-        status = entry.get("status", "not_found")
-        feedback = entry.get("feedback")
+    # Old plain-string entries are converted once at startup (_migrate_approvals)
+    status = entry["status"]
+    feedback = entry.get("feedback")
 
     print(f"[APPROVAL] Check: {approval_key} → {status}")
     result: Dict[str, Any] = {"ok": True, "status": status}
@@ -1354,11 +2304,86 @@ async def ci_check_approval(req: Request):
     return result
 
 
+SSE_KEEPALIVE_SECONDS = 15
+
+
+# Open SSE streams per worker; each holds a queue (and the response) for as long as the client stays
+SSE_MAX_SUBSCRIBERS = 64
+
+
+def ci_stream_token(repo: str, branch: str) -> str:
+    """Access token for /ci/progress/stream: HMAC-SHA256(NOTIFY_SECRET, "<repo>:<branch>") in hex."""
+    return hmac.new(NOTIFY_SECRET, f"{repo}:{branch}".encode(), hashlib.sha256).hexdigest()
+
+
+async def _ci_progress_events(ctx: str):
+    """SSE stream: current CI_PROGRESS snapshot, then every change; comment pings keep proxies from idling out.
+    The queue is registered before the snapshot is taken so an update in between is not lost."""
+    queue: asyncio.Queue = asyncio.Queue(maxsize=16)
+    _CI_SUBSCRIBERS.setdefault(ctx, set()).add(queue)
+    try:
+        yield b"data: " + orjson.dumps(await state_get("ci", ctx)) + b"\n\n"
+        while True:
+            try:
+                data = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield b": ping\n\n"
+                continue
+            yield b"data: " + data + b"\n\n"
+    finally:
+        subscribers = _CI_SUBSCRIBERS.get(ctx)
+        if subscribers is not None:
+            subscribers.discard(queue)
+            if not subscribers:
+                del _CI_SUBSCRIBERS[ctx]
+
+
+@app.get("/ci/progress/stream")
+async def ci_progress_stream(req: Request):
+    """Server-sent events with CI progress for a branch (instead of polling /status).
+    Needs ?token=ci_stream_token(repo, branch); disabled while NOTIFY_SECRET isn't set."""
+    branch = req.query_params.get("branch", "")
+    repo = req.query_params.get("repo") or GITHUB_REPO
+    if not NOTIFY_SECRET:
+        return ORJSONResponse({"ok": False, "error": "stream disabled: NOTIFY_SECRET not set"}, status_code=403)
+    if not hmac.compare_digest(ci_stream_token(repo, branch), req.query_params.get("token", "")):
+        print(f"[AUTH] Rejected /ci/progress/stream: bad token for {repo}:{branch}")
+        return ORJSONResponse(_BAD_SIGNATURE, status_code=401)
+    if sum(map(len, _CI_SUBSCRIBERS.values())) >= SSE_MAX_SUBSCRIBERS:
+        return ORJSONResponse({"ok": False, "error": "too many streams"}, status_code=503)
+    return StreamingResponse(
+        _ci_progress_events(_ctx_key(repo, branch)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# Commits that don't deserve a deploy notification, classified in one regex pass.
+# Group name → "skipped" reason in the webhook response.
+_DEPLOY_SKIP_RE = re.compile(
+    r"(?P<screenshot_commit>Add screenshot for issue)"  # screenshot uploads
+    r"|(?P<merge_from_main>Merge remote-tracking branch 'origin/(?:main|master)'|Merge branch '(?:main|master)')"  # CI infra sync
+    r"|(?P<devlog_update>^docs: update DEVLOG|for cherry-pick to main)"  # DEVLOG / cherry-pick meta-commits
+    r"|(?P<branch_context_update>^chore: update branch context)"  # branch context sync
+)
+_DEPLOY_SKIP_REASONS = MappingProxyType({
+    "screenshot_commit": "screenshot commit",
+    "merge_from_main": "merge from main",
+    "devlog_update": "devlog update",
+    "branch_context_update": "branch context update",
+})
+
+
+def _deploy_skip_reason(commit_msg: str) -> Optional[str]:
+    m = _DEPLOY_SKIP_RE.search(commit_msg) if commit_msg else None
+    return _DEPLOY_SKIP_REASONS[m.lastgroup] if m else None
+
+
 @app.post("/netlify/webhook")
 async def netlify_webhook(req: Request):
     """Receive Netlify deploy notification and notify developer in Telegram."""
     try:
-        payload = await req.json()
+        payload = await read_json(req)
     except Exception:
         return {"ok": False, "error": "invalid json"}
 
@@ -1372,18 +2397,24 @@ async def netlify_webhook(req: Request):
     ctx = _ctx_key(repo, branch)
 
     print(f"[NETLIFY] state={state} branch={branch} repo={repo} site={site_name}")
-    print(f"[NETLIFY] DEV_CHAT keys={list(DEV_CHAT.keys())}")
+
+    # Netlify retries deliveries; the same deploy id + state has already been handled
+    deploy_id = payload.get("id")
+    if deploy_id and not await mark_update_seen(f"netlify:{deploy_id}:{state}"):
+        print(f"[NETLIFY] Duplicate delivery for deploy {deploy_id} ({state}), skipping")
+        return {"ok": True, "skipped": "duplicate"}
 
     # Находим контекст разработчика
-    dev_ctx = DEV_CHAT.get(ctx)
+    dev_ctx = await state_get("dev_chat", ctx)
     if not dev_ctx:
         fallback_uid = _BRANCH_TO_DEV.get(branch)
         if fallback_uid:
-            dev_ctx = {"chat_id": fallback_uid, "user_id": fallback_uid, "first_name": "Dev"}
-            DEV_CHAT[ctx] = dev_ctx
+            dev_ctx = {"chat_id": fallback_uid, "user_id": fallback_uid, "first_name": "Dev", "first_name_html": "Dev",
+                       "updated_at": now_ts()}
+            await state_set("dev_chat", ctx, dev_ctx)
             print(f"[NETLIFY] Recovered DEV_CHAT for {ctx} from DEVELOPER_MAP (uid={fallback_uid})")
         else:
-            print(f"[NETLIFY] No chat for {ctx}, skipping")
+            print(f"[NETLIFY] No chat for {ctx}, skipping; DEV_CHAT keys={list(await state_all('dev_chat'))}")
             return {"ok": True, "skipped": "no chat mapped"}
 
     chat_id = dev_ctx["chat_id"]
@@ -1397,58 +2428,41 @@ async def netlify_webhook(req: Request):
         # If CI is actively working on this branch — ALWAYS save URL, don't notify yet
         # Must be checked FIRST: DEVLOG/screenshot/merge commits still produce valid deploys
         # and the URL should be included in the final "done" notification
-        if queue_is_busy(repo, branch):
+        if await queue_is_busy(repo, branch):
             LAST_DEPLOY_URL[ctx] = _netlify_app_url(ssl_url, site_name)
             print(f"[NETLIFY] CI active on {ctx} — saved deploy URL (commit: {commit_msg})")
             return {"ok": True, "skipped": "ci_active", "deploy_url_saved": True}
 
-        # Skip deploy notifications for screenshot uploads (not real code changes)
-        if commit_msg and "Add screenshot for issue" in commit_msg:
-            print(f"[NETLIFY] Skipping deploy notification for screenshot commit: {commit_msg}")
-            return {"ok": True, "skipped": "screenshot commit"}
-
-        # Skip deploy notifications for merge-from-main commits (CI infra sync, not real changes)
-        if commit_msg and ("Merge remote-tracking branch 'origin/main'" in commit_msg
-                           or "Merge remote-tracking branch 'origin/master'" in commit_msg
-                           or "Merge branch 'main'" in commit_msg
-                           or "Merge branch 'master'" in commit_msg):
-            print(f"[NETLIFY] Skipping deploy notification for merge-from-main: {commit_msg}")
-            return {"ok": True, "skipped": "merge from main"}
-
-        # Skip deploy notifications for DEVLOG updates (CI meta-commit, not real changes)
-        if commit_msg and (commit_msg.startswith("docs: update DEVLOG")
-                           or "for cherry-pick to main" in commit_msg):
-            print(f"[NETLIFY] Skipping deploy notification for DEVLOG/cherry-pick update: {commit_msg}")
-            return {"ok": True, "skipped": "devlog update"}
-
-        # Skip deploy notifications for CI infrastructure commits (branch context sync)
-        if commit_msg and commit_msg.startswith("chore: update branch context"):
-            print(f"[NETLIFY] Skipping deploy notification for branch context update: {commit_msg}")
-            return {"ok": True, "skipped": "branch context update"}
+        # Skip deploy notifications for CI meta-commits (not real code changes)
+        skip = _deploy_skip_reason(commit_msg)
+        if skip:
+            print(f"[NETLIFY] Skipping deploy notification ({skip}): {commit_msg}")
+            return {"ok": True, "skipped": skip}
 
         # Check if this is a deploy from branch just created/reset from main — save URL silently
+        now = time.time()
         created_at = BRANCH_JUST_CREATED.pop(ctx, 0)
-        if created_at and (time.time() - created_at) < 120:
+        if created_at and (now - created_at) < 120:
             LAST_DEPLOY_URL[ctx] = _netlify_app_url(ssl_url, site_name)
             print(f"[NETLIFY] Branch {branch} just created/reset — saved deploy URL silently")
             return {"ok": True, "skipped": "branch_just_created", "deploy_url_saved": True}
 
         # If task just finished (merged), send deploy link as a NEW message
         merged_info = RECENTLY_MERGED.pop(ctx, None)
-        if merged_info and (time.time() - merged_info["ts"]) < 300:
+        if merged_info and (now - merged_info["ts"]) < 300:
             app_url = _netlify_app_url(ssl_url, site_name)
             version = merged_info.get("version", "")
             version_hint = f" (v{version})" if version else ""
             text = f"✅ Билд готов{version_hint}! Можно тестировать\n\n🔗 <a href=\"{app_url}\">Открыть</a>"
-            tg_send_html(merged_info["chat_id"], text)
+            await tg_send_html(merged_info["chat_id"], text)
             print(f"[NETLIFY] Sent deploy message for {branch}")
             return {"ok": True, "deploy_sent": True}
 
         # Grace period: suppress standalone deploy notifications shortly after task completion
         # (handles multiple Netlify deploys arriving after merge — e.g. merge commit, infra commits)
         completed_at = RECENTLY_COMPLETED.get(ctx, 0)
-        if completed_at and (time.time() - completed_at) < 300:
-            print(f"[NETLIFY] Task recently completed on {ctx} ({time.time() - completed_at:.0f}s ago) — suppressing standalone deploy")
+        if completed_at and (now - completed_at) < 300:
+            print(f"[NETLIFY] Task recently completed on {ctx} ({now - completed_at:.0f}s ago) — suppressing standalone deploy")
             return {"ok": True, "skipped": "recently_completed"}
 
         app_url = _netlify_app_url(ssl_url, site_name)
@@ -1458,16 +2472,16 @@ async def netlify_webhook(req: Request):
         if safe_commit:
             text += f"\nКоммит: {safe_commit}"
         text += f"\n\n🔗 {app_url}"
-        tg_send_html(chat_id, text)
+        await tg_send_html(chat_id, text)
     elif state == "error":
         safe_error = html_escape(error_message) if error_message else ""
         text = f"❌ Деплой упал ({safe_branch})"
         text += f"\n\nСайт: {safe_site}"
         if safe_error:
             text += f"\nОшибка: {safe_error}"
-        tg_send_html(chat_id, text)
+        await tg_send_html(chat_id, text)
     elif state == "building":
-        tg_send_html(chat_id,
+        await tg_send_html(chat_id,
             f"🔨 Деплой начался\n"
             f"Сайт: {safe_site} | Ветка: {safe_branch}")
     else:
@@ -1477,10 +2491,481 @@ async def netlify_webhook(req: Request):
     return {"ok": True, "notified": True}
 
 
+# Strong refs to in-flight background tasks (asyncio only keeps weak refs)
+_BACKGROUND_TASKS: set = set()
+
+
+def _background_done(task: asyncio.Task) -> None:
+    _BACKGROUND_TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"[BG] {task.get_name()} failed: {type(task.exception()).__name__}: {task.exception()}")
+
+
+def spawn_background(coro, name: Optional[str] = None) -> asyncio.Task:
+    """Run a coroutine without awaiting it (the update task may finish first)."""
+    task = asyncio.create_task(coro, name=name)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+
 @app.post("/telegram/webhook")
 async def telegram_webhook(req: Request):
-    update = await req.json()
+    """Ack Telegram right away; the update is processed in a background task
+    (transcription + GitHub calls take seconds and would trigger Telegram retries)."""
+    update = await read_json(req)
+    update_id = update.get("update_id")
+    if update_id is not None and not await mark_update_seen(update_id):
+        print(f"[UPD {update_id}] duplicate delivery, skipped")
+        return {"ok": True}
+    spawn_background(_process_update_safe(update), name=f"update-{update.get('update_id')}")
+    return {"ok": True}
+
+
+def _update_chat_id(update: Dict[str, Any]) -> Optional[int]:
+    msg = update.get("message") or update.get("edited_message") or update.get("callback_query", {}).get("message") or {}
+    return msg.get("chat", {}).get("id")
+
+
+# Bound in-flight updates so a burst can't fan out into hundreds of GitHub/OpenAI calls
+_UPDATE_SEM = asyncio.Semaphore(UPDATE_CONCURRENCY)
+
+
+async def _process_update_safe(update: Dict[str, Any]) -> None:
+    try:
+        async with _UPDATE_SEM:
+            await asyncio.wait_for(_process_update(update), timeout=UPDATE_TIMEOUT_SECONDS)
+        return
+    except asyncio.TimeoutError:
+        print(f"[UPD {update.get('update_id', '?')}] TIMEOUT after {UPDATE_TIMEOUT_SECONDS}s")
+        notice = "Не успел обработать запрос, попробуй ещё раз."
+    except Exception as e:
+        print(f"[UPD {update.get('update_id', '?')}] ERROR {type(e).__name__}: {e}")
+        notice = f"Ошибка: {type(e).__name__}\n{e}"
+    chat_id = _update_chat_id(update)
+    if chat_id:
+        try:
+            await tg_send_message(chat_id, notice)
+        except Exception:
+            pass
+
+
+# ===================== CALLBACK HANDLERS =====================
+# cb = {"cb_id", "data", "chat_id", "reply_to_id", "msg_obj", "from_user", "clicker_id"};
+# author-bound actions also get "author_id" and "extra", draft actions "key" and "state".
+
+
+async def _cb_pick(cb: Dict[str, Any]) -> None:
+    """Cherry-pick marking. Format: pick:owner/repo:issue_number OR pick:issue_number (backward compat)."""
+    chat_id, reply_to_id, clicker_id, msg_obj = cb["chat_id"], cb["reply_to_id"], cb["clicker_id"], cb["msg_obj"]
+    pick_parts = cb["rest"]
+    # Parse repo and issue: "owner/repo:123" or just "123"
+    if "/" in pick_parts and ":" in pick_parts:
+        pick_repo, pick_issue = pick_parts.rsplit(":", 1)
+    else:
+        pick_repo = GITHUB_REPO
+        pick_issue = pick_parts
+    try:
+        issue_num = int(pick_issue)
+        # The DEVLOG.md read on the dev branch overlaps the label; DEVLOG is changed only once the label is on
+        dev_info = DEVELOPER_MAP.get(clicker_id)
+        if dev_info:
+            ok, devlog = await asyncio.gather(
+                gh_add_label(issue_num, "cherry-pick", repo=pick_repo),
+                gh_get_file(dev_info["branch"], "DEVLOG.md", repo=pick_repo),
+                return_exceptions=True,
+            )
+            if isinstance(ok, BaseException):
+                raise ok
+            if ok:
+                try:
+                    if isinstance(devlog, BaseException):
+                        raise devlog
+                    devlog_ok = await gh_mark_devlog_cherry_pick(dev_info["branch"], issue_num, devlog, repo=pick_repo)
+                except Exception as e:
+                    print(f"[PICK] DEVLOG.md error for #{issue_num}: {type(e).__name__}: {e}")
+                    devlog_ok = False
+                if devlog_ok:
+                    print(f"[PICK] DEVLOG.md updated for #{issue_num} on {dev_info['branch']} ({pick_repo})")
+                else:
+                    print(f"[PICK] DEVLOG.md update failed for #{issue_num}")
+        else:
+            ok = await gh_add_label(issue_num, "cherry-pick", repo=pick_repo)
+        if ok:
+
+            # Edit the message: replace button with ⭐ marker
+            await tg_edit_message_with_keyboard(
+                chat_id, reply_to_id,
+                msg_obj.get("text", "") + "\n\n⭐ Помечен для переноса в main",
+                [],  # remove keyboard
+            )
+            print(f"[PICK] Issue #{issue_num} marked for cherry-pick by user={clicker_id} ({pick_repo})")
+        else:
+            await tg_send_message(chat_id, f"Не удалось пометить #{pick_issue}", reply_to_message_id=reply_to_id)
+    except Exception as e:
+        print(f"[PICK] Error: {e}")
+        await tg_send_message(chat_id, f"Ошибка: {e}", reply_to_message_id=reply_to_id)
+
+
+async def _cb_ci_approval(cb: Dict[str, Any]) -> None:
+    """CI plan approval buttons: ci_ok / ci_no / ci_edit (not tied to the draft author)."""
+    action, chat_id, reply_to_id, clicker_id = cb["action"], cb["chat_id"], cb["reply_to_id"], cb["clicker_id"]
+    ci_issue = cb["rest"]
+
+    # Find the pending approval for this issue (any repo/branch); only_pending makes a double
+    # click (or ok + no from two people, on any workers) resolve the request only once
+    target_key = await approval_find_pending(ci_issue)
+    if target_key and action != "ci_edit":
+        if not await approval_set(target_key, "approved" if action == "ci_ok" else "rejected", only_pending=True):
+            target_key = None
+
+    if not target_key:
+        await tg_send_message(chat_id, f"Запрос на апрув #{ci_issue} не найден или уже обработан.", reply_to_message_id=reply_to_id)
+        return
+
+    if action == "ci_ok":
+        await tg_send_message(chat_id, f"✅ План одобрен — #{ci_issue}", reply_to_message_id=reply_to_id)
+        print(f"[APPROVAL] {target_key} → approved by user={clicker_id}")
+    elif action == "ci_edit":
+        # Ask user to type their corrections
+        await state_set("feedback", chat_id, {
+            "approval_key": target_key,
+            "issue_number": ci_issue,
+        })
+        await tg_send_message(chat_id,
+            f"✏️ Напиши поправки к плану #{ci_issue}.\n"
+            f"Следующее текстовое сообщение будет отправлено Claude как фидбек.",
+            reply_to_message_id=reply_to_id)
+        print(f"[APPROVAL] {target_key} → awaiting feedback from user={clicker_id}")
+    else:  # ci_no
+        await tg_send_message(chat_id, f"❌ План отклонён — #{ci_issue}", reply_to_message_id=reply_to_id)
+        print(f"[APPROVAL] {target_key} → rejected by user={clicker_id}")
+
+
+async def _cb_reset_confirm(cb: Dict[str, Any]) -> None:
+    chat_id, reply_to_id, clicker_id = cb["chat_id"], cb["reply_to_id"], cb["clicker_id"]
+    dev_info = DEVELOPER_MAP.get(clicker_id)
+    if not dev_info:
+        await tg_send_message(chat_id, "Dev-ветка не найдена.", reply_to_message_id=reply_to_id)
+        return
+    branch = dev_info["branch"]
+    reset_repo = resolve_repo(chat_id, clicker_id)
+    default_br = _default_branch(reset_repo)
+    try:
+        # Auto-backup: tag the branch before resetting (skip if already at default)
+        backup_note = ""
+        try:
+            branch_sha = await gh_get_branch_sha(branch, repo=reset_repo)
+            main_sha = await gh_get_branch_sha(default_br, repo=reset_repo)
+            if branch_sha != main_sha:
+                short_name = branch.split("/")[-1]  # "dev/Gleb" → "Gleb"
+                tag_name = f"backup/{short_name}/{time.strftime('%Y-%m-%d')}-{branch_sha[:7]}"
+                await gh_create_tag(tag_name, branch_sha, repo=reset_repo)
+                backup_note = f"\n📦 Бэкап: `{tag_name}`"
+        except Exception as tag_err:
+            print(f"[RESET] Backup tag failed (non-fatal): {tag_err}")
+            backup_note = "\n⚠️ Бэкап не удался (ветка всё равно сброшена)"
+
+        sha = await gh_force_reset_branch(branch, default_br, repo=reset_repo)
+        short_sha = sha[:7]
+        # Suppress Netlify deploy notification after reset (it's just a sync from main)
+        ctx = _ctx_key(reset_repo, branch)
+        BRANCH_JUST_CREATED[ctx] = time.time()
+        forget_screenshots(reset_repo, branch)
+        print(f"[RESET] user={clicker_id} branch={branch} → {default_br} ({short_sha}) repo={reset_repo}")
+        await tg_send_message(chat_id, f"✅ Ветка `{branch}` сброшена до `{default_br}` ({short_sha}).{backup_note}", reply_to_message_id=reply_to_id)
+    except Exception as e:
+        print(f"[RESET] ERROR user={clicker_id} branch={branch}: {e}")
+        await tg_send_message(chat_id, f"❌ Ошибка: {type(e).__name__}\n{e}", reply_to_message_id=reply_to_id)
+
+
+async def _cb_reset_cancel(cb: Dict[str, Any]) -> None:
+    chat_id, reply_to_id = cb["chat_id"], cb["reply_to_id"]
+    await tg_send_message(chat_id, "Отменил сброс.", reply_to_message_id=reply_to_id)
 
+
+async def _cb_noop(cb: Dict[str, Any]) -> None:
+    return
+
+
+async def _cb_toggle_option(cb: Dict[str, Any]) -> None:
+    """Toggle ticket options (re-render confirmation in-place)."""
+    action, chat_id, author_id, key, state = cb["action"], cb["chat_id"], cb["author_id"], cb["key"], cb["state"]
+    opts = dict(state.get("options", DEFAULT_OPTIONS))  # first toggle materializes the draft's own copy
+    opt_key = _OPTION_TOGGLES[action]
+    opts[opt_key] = not opts.get(opt_key, False)
+    state["options"] = opts
+    await pending_set(key, state)
+
+    # Text doesn't depend on options — swap only the keyboard
+    conf_msg_id = state.get("confirmation_message_id")
+    if conf_msg_id:
+        await tg_edit_reply_markup(chat_id, conf_msg_id, confirmation_keyboard(author_id, state))
+
+
+async def _cb_cancel(cb: Dict[str, Any]) -> None:
+    chat_id, reply_to_id, key = cb["chat_id"], cb["reply_to_id"], cb["key"]
+    await pending_pop(key)
+    await tg_send_message(chat_id, "Отменил.", reply_to_message_id=reply_to_id)
+
+
+async def _cb_edit(cb: Dict[str, Any]) -> None:
+    chat_id, reply_to_id, key, state = cb["chat_id"], cb["reply_to_id"], cb["key"], cb["state"]
+    state["stage"] = "edit"
+    await pending_set(key, state)
+    await tg_send_message(chat_id, "Пришли исправленный текст одним сообщением.", reply_to_message_id=reply_to_id)
+
+
+async def _cb_shot(cb: Dict[str, Any]) -> None:
+    chat_id, reply_to_id, key, state = cb["chat_id"], cb["reply_to_id"], cb["key"], cb["state"]
+    state["stage"] = "await_screenshot"
+    await pending_set(key, state)
+    await tg_send_message(chat_id, "Ок. Пришли скриншот (картинку) одним сообщением.", reply_to_message_id=reply_to_id)
+
+
+async def _attach_issue_extras(issue_number: int, issue_body: str, target_repo: str,
+                               chosen_branch: Optional[str], shot: Optional[Dict[str, Any]],
+                               shot_task: Optional[asyncio.Task]) -> None:
+    """Upload the draft screenshot (if any) and append branch/screenshot info to the issue body."""
+    branch_info = f"\nBranch: `{chosen_branch}`" if chosen_branch else ""
+    screenshot_info = ""
+
+    # Upload screenshot if present
+    if shot_task is not None:
+        if not chosen_branch:
+            chosen_branch, fetched = await asyncio.gather(gh_get_default_branch(repo=target_repo), shot_task)
+            branch_info = f"\nBranch: `{chosen_branch}` (default)"
+        else:
+            fetched = await shot_task
+        if not fetched:
+            raise RuntimeError("Could not resolve screenshot file_path in Telegram")
+
+        _, img_bytes = fetched
+        blob_key = f"{target_repo}:{chosen_branch}:{git_blob_sha(img_bytes)}"
+        html_url = _SCREENSHOT_URLS.get(blob_key)
+        if html_url:
+            print(f"[CREATE] Screenshot already on {chosen_branch}, reusing {html_url}")
+        else:
+            ext = shot.get("ext", "jpg")
+            path_in_repo = f"tickets/issue-{issue_number}/screenshot.{ext}"
+            html_url = await gh_put_file(
+                branch=chosen_branch,
+                path=path_in_repo,
+                content_bytes=img_bytes,
+                message=f"Add screenshot for issue #{issue_number}",
+                repo=target_repo,
+            )
+            _SCREENSHOT_URLS[blob_key] = html_url
+        screenshot_info = f"\nScreenshot: {html_url}"
+
+    if branch_info or screenshot_info:
+        updated_body = issue_body + "\n\n---\n" + (branch_info + screenshot_info).strip()
+        await gh_update_issue(issue_number, updated_body, repo=target_repo)
+
+
+async def _cb_create(cb: Dict[str, Any]) -> None:
+    chat_id, reply_to_id, key, state = cb["chat_id"], cb["reply_to_id"], cb["key"], cb["state"]
+    clicker_id, from_user = cb["clicker_id"], cb["from_user"]
+    if not await create_lock_acquire(key):
+        print(f"[CREATE] Duplicate click ignored key={key}")
+        return
+    # Draft may have been consumed by a concurrent click that just released the lock
+    if await pending_get(key) is None:
+        await create_lock_release(key)
+        return
+    # Screenshot download from Telegram doesn't depend on anything GitHub-side
+    shot = state.get("screenshot")
+    shot_task = asyncio.create_task(tg_fetch_file(shot["file_id"])) if shot else None
+    try:
+        dev_info = DEVELOPER_MAP.get(clicker_id)
+        extra_labels: List[str] = []
+        branch = None
+        # Use repo stored in PENDING (captured at draft time) — survives bot restarts
+        target_repo = state.get("repo") or resolve_repo(chat_id, clicker_id)
+
+        if not target_repo:
+            await tg_send_message(chat_id, "Выбери репозиторий: /repo", reply_to_message_id=reply_to_id)
+            return
+
+        default_br = _default_branch(target_repo)
+
+        # Add CI option labels
+        opts = state.get("options", DEFAULT_OPTIONS)
+        for opt_key, label_name in OPTION_LABELS.items():
+            if opts.get(opt_key):
+                extra_labels.append(label_name)
+
+        if dev_info:
+            branch = dev_info["branch"]
+            extra_labels.append(dev_info["label"])
+            ctx = _ctx_key(target_repo, branch)
+            # Branch check and queue check are independent round trips
+            _, active = await asyncio.gather(
+                ensure_dev_branch(branch, default_br, target_repo),
+                queue_active(target_repo, branch),
+            )
+            is_busy = active is not None
+            # Запоминаем chat_id ТОЛЬКО при создании тикета
+            first_name = from_user.get("first_name", "")
+            await state_set("dev_chat", ctx, {
+                "chat_id": chat_id,
+                "user_id": clicker_id,
+                "first_name": first_name,
+                "first_name_html": html_escape(first_name),
+                "updated_at": now_ts(),
+            })
+            print(f"[CREATE] Developer: user={clicker_id} → branch={branch} label={dev_info['label']} chat={chat_id} repo={target_repo}")
+            print(f"[CREATE] DEV_CHAT updated: {ctx} → chat_id={chat_id}")
+        else:
+            is_busy = False
+            print(f"[CREATE] No developer mapping for user={clicker_id}, using default branch")
+
+        issue_fmt = format_issue(state["text"], chat_id, from_user, dev_info=dev_info)
+
+        # Decide: queue (pending) or execute immediately
+        if is_busy:
+            extra_labels.append("queue:pending")
+
+        # Create issue on GitHub (with queue:pending if busy, without if free)
+        issue = await gh_create_issue(issue_fmt["title"], issue_fmt["body"], extra_labels=extra_labels, repo=target_repo)
+        issue_url = issue["html_url"]
+        issue_number = issue["number"]
+
+        # Screenshot upload + body update overlap only with queue reads: both must land before
+        # queue:execute is added, since that label starts CI on the dev branch
+        attach_extras = functools.partial(
+            _attach_issue_extras, issue_number, issue_fmt["body"], target_repo,
+            dev_info["branch"] if dev_info else None, shot, shot_task)
+
+        repo_tag = f" [{_repo_short(target_repo)}]"
+
+        if is_busy:
+            # Issue created with queue:pending — notify about queue position
+            # (active was read together with the busy check above)
+            _, pending_count = await asyncio.gather(attach_extras(), queue_size(target_repo, branch))
+            active_num = active.get("issue_number", "?") if active else "?"
+            await tg_send_html(chat_id,
+                f"📋 Тикет{repo_tag} <a href=\"{issue_url}\">#{issue_number}</a> добавлен в очередь\n\n"
+                f"Позиция: {pending_count}\n"
+                f"Сейчас выполняется: #{active_num}\n\n"
+                f"Тикет запустится автоматически когда подойдёт очередь.",
+                )
+        else:
+            # Issue created without queue label — trigger CI now
+            queue_info = ""
+            if branch:
+                _, remaining_list = await asyncio.gather(attach_extras(), queue_list_pending(target_repo, branch))
+                await gh_add_label(issue_number, "queue:execute", repo=target_repo)
+                await queue_set_active(target_repo, branch, issue_number, issue_fmt["title"])
+                if remaining_list:
+                    q_lines = [f"📋 В очереди: {len(remaining_list)}"]
+                    for qi, qiss in enumerate(remaining_list[:3], 1):
+                        q_lines.append(f"  {qi}. [{_repo_short(target_repo)}] #{qiss['number']} — {qiss['title'][:40]}")
+                    queue_info = "\n\n" + "\n".join(q_lines)
+            else:
+                await attach_extras()
+
+            await tg_send_message(chat_id,
+                f"📋 Тикет создан!{repo_tag}\n\n"
+                f"#{issue_number} ({from_user.get('first_name', '')}): {issue_fmt['title']}\n"
+                f"{issue_url}\n\n"
+                f"Claude скоро возьмётся за работу...{queue_info}",
+                reply_to_message_id=reply_to_id)
+
+    except Exception as e:
+        await tg_send_message(chat_id, f"Ошибка: {type(e).__name__}\n{e}", reply_to_message_id=reply_to_id)
+    finally:
+        if shot_task is not None and not shot_task.done():
+            shot_task.cancel()
+        await pending_pop(key)
+        await create_lock_release(key)
+
+
+# Parts of /debug that only depend on env config (fixed after import)
+_DEBUG_REPOS = "\n".join(
+    f"  {cfg['short']}: {rname} (default: {cfg['default_branch']})" for rname, cfg in REPO_CONFIG.items()
+) or "(single repo mode)"
+_DEBUG_ENV = (
+    f"WEBAPP_PROD: {'✅' if WEBAPP_URL_PRODUCTION else '❌'}\n"
+    f"WEBAPP_DEV1: {'✅' if WEBAPP_URL_DEV_1 else '❌'} {WEBAPP_DEV_1_NAME}\n"
+    f"WEBAPP_DEV2: {'✅' if WEBAPP_URL_DEV_2 else '❌'} {WEBAPP_DEV_2_NAME}\n"
+    f"NETLIFY_SITE_MAP: {NETLIFY_SITE_MAP or '(empty)'}\n"
+    f"NETLIFY_APP_PATHS: {NETLIFY_APP_PATHS or '(empty)'}\n"
+    f"REPO_TO_SITE: {_REPO_TO_SITE or '(empty)'}\n"
+    f"PERSIST_DIR: {_PERSIST_DIR}\n"
+)
+
+
+async def dev_command_target(chat_id: int, user_id: int, message_id: int) -> Optional[Tuple[str, str]]:
+    """(branch, repo) for /reset, /clear, /queue, /status — or None after telling the user they have no dev branch."""
+    dev_info = DEVELOPER_MAP.get(user_id)
+    if not dev_info:
+        await tg_send_message(chat_id, "У тебя нет привязанной dev-ветки. Проверь DEVELOPER_MAP.", reply_to_message_id=message_id)
+        return None
+    return dev_info["branch"], resolve_repo(chat_id, user_id)
+
+
+# /status workflow steps: (phase_num, name, needed option or None for always-on)
+_WORKFLOW_STEPS = (
+    ("1", "Планирование (Opus)", None),
+    ("2", "Codex ревью", "multi_agent"),
+    ("A", "Апрув плана", "approve"),
+    ("3", "Реализация (Opus)", None),
+    ("4", "Codex код ревью", "multi_agent"),
+    ("5", "Тестирование", "testing"),
+    ("6", "Финализация", None),
+)
+# Applicable steps for every (multi_agent, testing, approve) combination, built once
+_STEPS_BY_OPTS: Dict[Tuple[bool, bool, bool], Tuple[Tuple[str, str], ...]] = {
+    (multi, testing, approve): tuple(
+        (num, name) for num, name, opt in _WORKFLOW_STEPS
+        if opt is None or {"multi_agent": multi, "testing": testing, "approve": approve}[opt]
+    )
+    for multi in (False, True) for testing in (False, True) for approve in (False, True)
+}
+
+
+# /status and /queue pressed several times in a row are answered once, by the last press
+STATUS_DEBOUNCE_SECONDS = 0.2
+_COMMAND_DEBOUNCE: Dict[Tuple[int, int, str], int] = {}
+
+
+async def command_debounce(chat_id: int, user_id: int, cmd: str) -> bool:
+    """Wait out the debounce window; True only for the last of back-to-back identical commands."""
+    key = (chat_id, user_id, cmd)
+    seq = _COMMAND_DEBOUNCE.get(key, 0) + 1
+    _COMMAND_DEBOUNCE[key] = seq
+    await asyncio.sleep(STATUS_DEBOUNCE_SECONDS)
+    if _COMMAND_DEBOUNCE.get(key) != seq:
+        return False
+    del _COMMAND_DEBOUNCE[key]
+    return True
+
+
+# Dispatch by callback_data prefix (text before the first ":")
+CB_OPEN_HANDLERS = {  # anyone in the chat may press
+    "pick": _cb_pick,
+    "ci_ok": _cb_ci_approval,
+    "ci_no": _cb_ci_approval,
+    "ci_edit": _cb_ci_approval,
+}
+CB_AUTHOR_HANDLERS = {  # "<action>:<author_id>", no draft needed
+    "reset_confirm": _cb_reset_confirm,
+    "reset_cancel": _cb_reset_cancel,
+}
+CB_DRAFT_HANDLERS = {  # "<action>:<author_id>", operate on the author's PENDING draft
+    "noop": _cb_noop,
+    "opt_ma": _cb_toggle_option,
+    "opt_test": _cb_toggle_option,
+    "opt_appr": _cb_toggle_option,
+    "cancel": _cb_cancel,
+    "edit": _cb_edit,
+    "shot": _cb_shot,
+    "create": _cb_create,
+}
+
+
+async def _process_update(update: Dict[str, Any]) -> None:
     # ---------- DEBUG LOG ----------
     update_id = update.get("update_id", "?")
     msg = update.get("message") or update.get("callback_query", {}).get("message") or {}
@@ -1503,322 +2988,65 @@ async def telegram_webhook(req: Request):
         chat_id = chat.get("id")
         reply_to_id = msg_obj.get("message_id")
 
-        try:
-            tg_answer_callback(cb_id)
-        except Exception:
-            pass
+        # Ack the spinner concurrently with the actual handling
+        spawn_background(tg_answer_callback(cb_id), name="answerCallbackQuery")
 
         if not chat_id or not clicker_id:
-            return {"ok": True}
-
-        # --- Cherry-pick marking (not tied to PENDING) ---
-        # Format: pick:owner/repo:issue_number OR pick:issue_number (backward compat)
-        if data.startswith("pick:"):
-            pick_parts = data.split(":", 1)[1]
-            # Parse repo and issue: "owner/repo:123" or just "123"
-            if "/" in pick_parts and ":" in pick_parts:
-                pick_repo, pick_issue = pick_parts.rsplit(":", 1)
-            else:
-                pick_repo = GITHUB_REPO
-                pick_issue = pick_parts
-            try:
-                issue_num = int(pick_issue)
-                ok = gh_add_label(issue_num, "cherry-pick", repo=pick_repo)
-                if ok:
-                    # Also update DEVLOG.md on the dev branch
-                    dev_info = DEVELOPER_MAP.get(clicker_id)
-                    if dev_info:
-                        devlog_ok = gh_mark_devlog_cherry_pick(dev_info["branch"], issue_num, repo=pick_repo)
-                        if devlog_ok:
-                            print(f"[PICK] DEVLOG.md updated for #{issue_num} on {dev_info['branch']} ({pick_repo})")
-                        else:
-                            print(f"[PICK] DEVLOG.md update failed for #{issue_num}")
-
-                    # Edit the message: replace button with ⭐ marker
-                    tg_edit_message_with_keyboard(
-                        chat_id, reply_to_id,
-                        msg_obj.get("text", "") + "\n\n⭐ Помечен для переноса в main",
-                        [],  # remove keyboard
-                    )
-                    print(f"[PICK] Issue #{issue_num} marked for cherry-pick by user={clicker_id} ({pick_repo})")
-                else:
-                    tg_send_message(chat_id, f"Не удалось пометить #{pick_issue}", reply_to_message_id=reply_to_id)
-            except Exception as e:
-                print(f"[PICK] Error: {e}")
-                tg_send_message(chat_id, f"Ошибка: {e}", reply_to_message_id=reply_to_id)
-            return {"ok": True}
-
-        # --- CI Approval callbacks (not tied to PENDING author) ---
-        if data.startswith("ci_ok:") or data.startswith("ci_no:") or data.startswith("ci_edit:"):
-            ci_issue = data.split(":", 1)[1]
-
-            # Find approval key for this issue across all repos/branches
-            target_key = None
-            for key_candidate, entry in APPROVAL_REQUESTS.items():
-                entry_status = entry.get("status") if isinstance(entry, dict) else entry
-                if key_candidate.endswith(f":{ci_issue}") and entry_status == "pending":
-                    target_key = key_candidate
-                    break
-
-            if not target_key:
-                tg_send_message(chat_id, f"Запрос на апрув #{ci_issue} не найден или уже обработан.", reply_to_message_id=reply_to_id)
-                return {"ok": True}
-
-            if data.startswith("ci_ok:"):
-                APPROVAL_REQUESTS[target_key] = {"status": "approved", "feedback": None}
-                tg_send_message(chat_id, f"✅ План одобрен — #{ci_issue}", reply_to_message_id=reply_to_id)
-                print(f"[APPROVAL] {target_key} → approved by user={clicker_id}")
-            elif data.startswith("ci_edit:"):
-                # Ask user to type their corrections
-                APPROVAL_AWAITING_FEEDBACK[chat_id] = {
-                    "approval_key": target_key,
-                    "issue_number": ci_issue,
-                }
-                tg_send_message(chat_id,
-                    f"✏️ Напиши поправки к плану #{ci_issue}.\n"
-                    f"Следующее текстовое сообщение будет отправлено Claude как фидбек.",
-                    reply_to_message_id=reply_to_id)
-                print(f"[APPROVAL] {target_key} → awaiting feedback from user={clicker_id}")
-            else:  # ci_no
-                APPROVAL_REQUESTS[target_key] = {"status": "rejected", "feedback": None}
-                tg_send_message(chat_id, f"❌ План отклонён — #{ci_issue}", reply_to_message_id=reply_to_id)
-                print(f"[APPROVAL] {target_key} → rejected by user={clicker_id}")
-            return {"ok": True}
-
-        parts = data.split(":")
-        action = parts[0] if parts else ""
-        if len(parts) < 2:
-            return {"ok": True}
+            return
 
+        cb: Dict[str, Any] = {
+            "cb_id": cb_id,
+            "data": data,
+            "chat_id": chat_id,
+            "reply_to_id": reply_to_id,
+            "msg_obj": msg_obj,
+            "from_user": from_user,
+            "clicker_id": clicker_id,
+        }
+        # "<action>:<rest>" — partition avoids building a list per click
+        action, sep, rest = data.partition(":")
+        if not sep:
+            return
+        cb["action"], cb["rest"] = action, rest
+
+        handler = CB_OPEN_HANDLERS.get(action)
+        if handler:
+            await handler(cb)
+            return
+
+        author_part, _, extra = rest.partition(":")
         try:
-            author_id = int(parts[1])
+            author_id = int(author_part)
         except ValueError:
-            return {"ok": True}
-
-        extra = ":".join(parts[2:]) if len(parts) > 2 else ""
+            return
 
         if clicker_id != author_id:
-            tg_answer_callback(cb_id, text="Это не твои кнопки 🙂", show_alert=False)
-            return {"ok": True}
-
-        # Reset branch handlers (не зависят от PENDING)
-        if action == "reset_confirm":
-            dev_info = DEVELOPER_MAP.get(clicker_id)
-            if not dev_info:
-                tg_send_message(chat_id, "Dev-ветка не найдена.", reply_to_message_id=reply_to_id)
-                return {"ok": True}
-            branch = dev_info["branch"]
-            reset_repo = resolve_repo(chat_id, clicker_id)
-            default_br = _default_branch(reset_repo)
-            try:
-                # Auto-backup: tag the branch before resetting (skip if already at default)
-                backup_note = ""
-                try:
-                    branch_sha = gh_get_branch_sha(branch, repo=reset_repo)
-                    main_sha = gh_get_branch_sha(default_br, repo=reset_repo)
-                    if branch_sha != main_sha:
-                        short_name = branch.split("/")[-1]  # "dev/Gleb" → "Gleb"
-                        tag_name = f"backup/{short_name}/{time.strftime('%Y-%m-%d')}-{branch_sha[:7]}"
-                        gh_create_tag(tag_name, branch_sha, repo=reset_repo)
-                        backup_note = f"\n📦 Бэкап: `{tag_name}`"
-                except Exception as tag_err:
-                    print(f"[RESET] Backup tag failed (non-fatal): {tag_err}")
-                    backup_note = "\n⚠️ Бэкап не удался (ветка всё равно сброшена)"
-
-                sha = gh_force_reset_branch(branch, default_br, repo=reset_repo)
-                short_sha = sha[:7]
-                # Suppress Netlify deploy notification after reset (it's just a sync from main)
-                ctx = _ctx_key(reset_repo, branch)
-                BRANCH_JUST_CREATED[ctx] = time.time()
-                print(f"[RESET] user={clicker_id} branch={branch} → {default_br} ({short_sha}) repo={reset_repo}")
-                tg_send_message(chat_id, f"✅ Ветка `{branch}` сброшена до `{default_br}` ({short_sha}).{backup_note}", reply_to_message_id=reply_to_id)
-            except Exception as e:
-                print(f"[RESET] ERROR user={clicker_id} branch={branch}: {e}")
-                tg_send_message(chat_id, f"❌ Ошибка: {type(e).__name__}\n{e}", reply_to_message_id=reply_to_id)
-            return {"ok": True}
+            await tg_answer_callback(cb_id, text="Это не твои кнопки 🙂", show_alert=False)
+            return
+        cb["author_id"] = author_id
+        cb["extra"] = extra
 
-        if action == "reset_cancel":
-            tg_send_message(chat_id, "Отменил сброс.", reply_to_message_id=reply_to_id)
-            return {"ok": True}
+        handler = CB_AUTHOR_HANDLERS.get(action)
+        if handler:
+            await handler(cb)
+            return
 
         key = state_key(chat_id, author_id)
-        state = PENDING.get(key)
+        state = await pending_get(key)
         if not state:
-            tg_send_message(chat_id, "Черновик не найден. Пришли голосовое ещё раз.", reply_to_message_id=reply_to_id)
-            return {"ok": True}
-
-        if action == "noop":
-            return {"ok": True}
-
-        # Toggle ticket options (re-render confirmation in-place)
-        if action in ("opt_ma", "opt_test", "opt_appr"):
-            opts = state.get("options", dict(DEFAULT_OPTIONS))
-            toggle_map = {"opt_ma": "multi_agent", "opt_test": "testing", "opt_appr": "approve_plan"}
-            opt_key = toggle_map[action]
-            opts[opt_key] = not opts.get(opt_key, False)
-            state["options"] = opts
-
-            # Edit existing message with updated text and keyboard
-            conf_msg_id = state.get("confirmation_message_id")
-            if conf_msg_id:
-                tg_edit_message_with_keyboard(
-                    chat_id, conf_msg_id,
-                    confirmation_text(state),
-                    confirmation_keyboard(author_id, state),
-                )
-            return {"ok": True}
-
-        if action == "cancel":
-            PENDING.pop(key, None)
-            tg_send_message(chat_id, "Отменил.", reply_to_message_id=reply_to_id)
-            return {"ok": True}
-
-        if action == "edit":
-            state["stage"] = "edit"
-            tg_send_message(chat_id, "Пришли исправленный текст одним сообщением.", reply_to_message_id=reply_to_id)
-            return {"ok": True}
-
-        if action == "shot":
-            state["stage"] = "await_screenshot"
-            tg_send_message(chat_id, "Ок. Пришли скриншот (картинку) одним сообщением.", reply_to_message_id=reply_to_id)
-            return {"ok": True}
-
-        if action == "create":
-            try:
-                dev_info = DEVELOPER_MAP.get(clicker_id)
-                extra_labels: List[str] = []
-                branch = None
-                # Use repo stored in PENDING (captured at draft time) — survives bot restarts
-                target_repo = state.get("repo") or resolve_repo(chat_id, clicker_id)
-
-                if not target_repo:
-                    tg_send_message(chat_id, "Выбери репозиторий: /repo", reply_to_message_id=reply_to_id)
-                    return {"ok": True}
-
-                default_br = _default_branch(target_repo)
-
-                # Add CI option labels
-                opts = state.get("options", DEFAULT_OPTIONS)
-                for opt_key, label_name in OPTION_LABELS.items():
-                    if opts.get(opt_key):
-                        extra_labels.append(label_name)
-
-                if dev_info:
-                    branch = dev_info["branch"]
-                    extra_labels.append(dev_info["label"])
-                    ctx = _ctx_key(target_repo, branch)
-                    # Ensure dev branch exists (create from default if deleted after merge)
-                    if not gh_branch_exists(branch, repo=target_repo):
-                        try:
-                            gh_create_branch(branch, default_br, repo=target_repo)
-                            BRANCH_JUST_CREATED[ctx] = time.time()
-                        except Exception as e:
-                            print(f"[CREATE] Failed to create branch {branch} in {target_repo}: {e}")
-                    # Запоминаем chat_id ТОЛЬКО при создании тикета
-                    DEV_CHAT[ctx] = {
-                        "chat_id": chat_id,
-                        "user_id": clicker_id,
-                        "first_name": from_user.get("first_name", ""),
-                    }
-                    print(f"[CREATE] Developer: user={clicker_id} → branch={branch} label={dev_info['label']} chat={chat_id} repo={target_repo}")
-                    print(f"[CREATE] DEV_CHAT updated: {ctx} → chat_id={chat_id}")
-                else:
-                    print(f"[CREATE] No developer mapping for user={clicker_id}, using default branch")
-
-                issue_fmt = format_issue(state["text"], chat_id, from_user, dev_info=dev_info)
-
-                # Decide: queue (pending) or execute immediately
-                is_busy = branch and queue_is_busy(target_repo, branch)
-                if is_busy:
-                    extra_labels.append("queue:pending")
-
-                # Create issue on GitHub (with queue:pending if busy, without if free)
-                issue = gh_create_issue(issue_fmt["title"], issue_fmt["body"], extra_labels=extra_labels, repo=target_repo)
-                issue_url = issue["html_url"]
-                issue_number = issue["number"]
-                issue_body = issue_fmt["body"]
-
-                # Branch from developer mapping or default
-                chosen_branch: Optional[str] = dev_info["branch"] if dev_info else None
-                branch_info = f"\nBranch: `{chosen_branch}`" if chosen_branch else ""
-                screenshot_info = ""
-
-                # Upload screenshot if present
-                if state.get("screenshot"):
-                    if not chosen_branch:
-                        chosen_branch = gh_get_default_branch(repo=target_repo)
-                        branch_info = f"\nBranch: `{chosen_branch}` (default)"
-
-                    shot = state["screenshot"]
-                    file_path = tg_get_file_path(shot["file_id"])
-                    if not file_path:
-                        raise RuntimeError("Could not resolve screenshot file_path in Telegram")
-
-                    img_bytes = tg_download_file_bytes(file_path)
-                    ext = shot.get("ext", "jpg")
-                    path_in_repo = f"tickets/issue-{issue_number}/screenshot.{ext}"
-                    html_url = gh_put_file(
-                        branch=chosen_branch,
-                        path=path_in_repo,
-                        content_bytes=img_bytes,
-                        message=f"Add screenshot for issue #{issue_number}",
-                        repo=target_repo,
-                    )
-                    screenshot_info = f"\nScreenshot: {html_url}"
-
-                if branch_info or screenshot_info:
-                    updated_body = issue_body + "\n\n---\n" + (branch_info + screenshot_info).strip()
-                    gh_update_issue(issue_number, updated_body, repo=target_repo)
-
-                repo_tag = f" [{_repo_short(target_repo)}]"
-
-                if is_busy:
-                    # Issue created with queue:pending — notify about queue position
-                    pending_count = queue_size(target_repo, branch)
-                    ctx = _ctx_key(target_repo, branch)
-                    active = ACTIVE_TICKET.get(ctx, {})
-                    active_num = active.get("issue_number", "?") if active else "?"
-                    tg_send_html(chat_id,
-                        f"📋 Тикет{repo_tag} <a href=\"{issue_url}\">#{issue_number}</a> добавлен в очередь\n\n"
-                        f"Позиция: {pending_count}\n"
-                        f"Сейчас выполняется: #{active_num}\n\n"
-                        f"Тикет запустится автоматически когда подойдёт очередь.",
-                        )
-                else:
-                    # Issue created without queue label — trigger CI now
-                    if branch:
-                        gh_add_label(issue_number, "queue:execute", repo=target_repo)
-                        queue_set_active(target_repo, branch, issue_number, issue_fmt["title"])
-
-                    queue_info = ""
-                    if branch:
-                        remaining_list = queue_list_pending(target_repo, branch)
-                        if remaining_list:
-                            q_lines = [f"📋 В очереди: {len(remaining_list)}"]
-                            for qi, qiss in enumerate(remaining_list[:3], 1):
-                                q_lines.append(f"  {qi}. [{_repo_short(target_repo)}] #{qiss['number']} — {qiss['title'][:40]}")
-                            queue_info = "\n\n" + "\n".join(q_lines)
-
-                    tg_send_message(chat_id,
-                        f"📋 Тикет создан!{repo_tag}\n\n"
-                        f"#{issue_number} ({from_user.get('first_name', '')}): {issue_fmt['title']}\n"
-                        f"{issue_url}\n\n"
-                        f"Claude скоро возьмётся за работу...{queue_info}",
-                        reply_to_message_id=reply_to_id)
+            await tg_send_message(chat_id, "Черновик не найден. Пришли голосовое ещё раз.", reply_to_message_id=reply_to_id)
+            return
+        cb["key"], cb["state"] = key, state
 
-            except Exception as e:
-                tg_send_message(chat_id, f"Ошибка: {type(e).__name__}\n{e}", reply_to_message_id=reply_to_id)
-            finally:
-                PENDING.pop(key, None)
-
-            return {"ok": True}
-
-        return {"ok": True}
+        handler = CB_DRAFT_HANDLERS.get(action)
+        if handler:
+            await handler(cb)
+        return
 
     # ---------- MESSAGES ----------
     msg = update.get("message") or update.get("edited_message")
     if not msg:
-        return {"ok": True}
+        return
 
     chat = msg.get("chat", {}) or {}
     chat_id = chat.get("id")
@@ -1827,7 +3055,7 @@ async def telegram_webhook(req: Request):
     message_id = msg.get("message_id")
 
     if not chat_id or not user_id:
-        return {"ok": True}
+        return
 
     in_group = is_group(chat)
     key = state_key(chat_id, user_id)
@@ -1836,8 +3064,11 @@ async def telegram_webhook(req: Request):
 
     # НЕ перезаписываем DEV_CHAT тут — только при создании тикета (action=="create")
 
+    # Only "/..." texts (and a bare "help") can be commands — group chatter skips the lower/split
+    is_command = text.startswith("/") or (len(text) == 4 and text.lower() == "help")
+    cmd_base = text.lower().partition("@")[0] if is_command else ""
+
     # Help
-    cmd_base = text.lower().split("@")[0]
     if cmd_base in ("/start", "/help", "help"):
         help_lines = [
             "📋 <b>Команды</b>\n",
@@ -1855,11 +3086,11 @@ async def telegram_webhook(req: Request):
             help_lines.insert(1, "<i>В группе: /ticket → голосовое (120 сек) или /ticket текст</i>\n")
         else:
             help_lines.insert(1, "<i>Пришли голосовое или /ticket текст — создам GitHub Issue</i>\n")
-        tg_send_html(chat_id, "\n".join(help_lines), reply_to_message_id=message_id)
-        return {"ok": True}
+        await tg_send_html(chat_id, "\n".join(help_lines), reply_to_message_id=message_id)
+        return
 
     # Repo selection (multi-repo)
-    if cmd_base == "/repo" or text.lower().startswith("/repo "):
+    if cmd_base == "/repo" or cmd_base.startswith("/repo "):
         arg = text.split(maxsplit=1)[1].strip() if " " in text else ""
         if not arg:
             # Show current + list
@@ -1872,38 +3103,34 @@ async def telegram_webhook(req: Request):
                     lines.append(f"  /{cfg['short']} — {repo_name}{marker}")
             else:
                 lines.append("Multi-repo не настроен (GITHUB_REPOS не задан)")
-            tg_send_message(chat_id, "\n".join(lines), reply_to_message_id=message_id)
+            await tg_send_message(chat_id, "\n".join(lines), reply_to_message_id=message_id)
         else:
             # Set by short name or full name
             target = SHORT_TO_REPO.get(arg.lower()) or (arg if arg in REPO_CONFIG else None)
             if target:
                 USER_ACTIVE_REPO[user_id] = target
                 _save_user_active_repo()
-                tg_send_message(chat_id, f"Репо: {target} ({_repo_short(target)})", reply_to_message_id=message_id)
+                await tg_send_message(chat_id, f"Репо: {target} ({_repo_short(target)})", reply_to_message_id=message_id)
             else:
                 available = ", ".join(f"/{cfg['short']}" for cfg in REPO_CONFIG.values()) or "(нет)"
-                tg_send_message(chat_id, f"Неизвестный репо: {arg}\nДоступные: {available}", reply_to_message_id=message_id)
-        return {"ok": True}
+                await tg_send_message(chat_id, f"Неизвестный репо: {arg}\nДоступные: {available}", reply_to_message_id=message_id)
+        return
 
     # Apps menu
     if cmd_base == "/apps":
         print(f"[CMD] /apps from user={user_id} chat={chat_id} group={in_group}")
-        show_apps_menu(chat_id, reply_to_message_id=message_id, in_group=in_group)
-        return {"ok": True}
+        await show_apps_menu(chat_id, reply_to_message_id=message_id, in_group=in_group)
+        return
 
     # Debug info
     if cmd_base == "/debug":
         uptime = int(time.time()) - BOT_STARTED_AT
         mins = uptime // 60
 
-        # Queue stats
-        active_contexts = [k for k, t in ACTIVE_TICKET.items() if t is not None]
-
-        # Repos info
-        repos_info = []
-        for rname, cfg in REPO_CONFIG.items():
-            repos_info.append(f"  {cfg['short']}: {rname} (default: {cfg['default_branch']})")
-        repos_str = "\n".join(repos_info) if repos_info else "(single repo mode)"
+        # Queue stats and state counters are independent reads
+        active_state, dev_chats, pending_count, armed_count = await asyncio.gather(
+            state_all("active"), state_all("dev_chat"), pending_total(), armed_total())
+        active_contexts = list(active_state)
 
         current_repo = resolve_repo(chat_id, user_id)
 
@@ -1912,22 +3139,16 @@ async def telegram_webhook(req: Request):
             f"Version: {BOT_VERSION}\n"
             f"Build: {BUILD_ID}\n"
             f"Uptime: {mins}m {uptime % 60}s\n"
-            f"Pending tickets: {len(PENDING)}\n"
-            f"Armed users: {len(ARMED)}\n"
+            f"Pending tickets: {pending_count}\n"
+            f"Armed users: {armed_count}\n"
             f"Queue: GitHub Issues (queue:pending/queue:execute)\n"
             f"Active contexts: {active_contexts or '—'}\n"
             f"---\n"
-            f"REPOS:\n{repos_str}\n"
+            f"REPOS:\n{_DEBUG_REPOS}\n"
             f"CHAT_TO_REPO: {CHAT_TO_REPO or '(empty)'}\n"
             f"Current repo: {current_repo}\n"
-            f"WEBAPP_PROD: {'✅' if WEBAPP_URL_PRODUCTION else '❌'}\n"
-            f"WEBAPP_DEV1: {'✅' if WEBAPP_URL_DEV_1 else '❌'} {WEBAPP_DEV_1_NAME}\n"
-            f"WEBAPP_DEV2: {'✅' if WEBAPP_URL_DEV_2 else '❌'} {WEBAPP_DEV_2_NAME}\n"
-            f"NETLIFY_SITE_MAP: {NETLIFY_SITE_MAP or '(empty)'}\n"
-            f"NETLIFY_APP_PATHS: {NETLIFY_APP_PATHS or '(empty)'}\n"
-            f"REPO_TO_SITE: {_REPO_TO_SITE or '(empty)'}\n"
-            f"PERSIST_DIR: {_PERSIST_DIR}\n"
-            f"DEV_CHAT: {dict(list(DEV_CHAT.items())[:5]) or '(empty)'}\n"
+            f"{_DEBUG_ENV}"
+            f"DEV_CHAT: {dict(list(dev_chats.items())[:5]) or '(empty)'}\n"
             f"REQUIRE_TICKET_CMD: {REQUIRE_TICKET_COMMAND}\n"
             f"Group chat: {in_group}\n"
             f"---\n"
@@ -1936,86 +3157,79 @@ async def telegram_webhook(req: Request):
             f"Your dev mapping: {DEVELOPER_MAP.get(user_id, 'not mapped')}\n"
             f"Total devs mapped: {len(DEVELOPER_MAP)}"
         )
-        tg_send_message(chat_id, debug_text, reply_to_message_id=message_id)
-        return {"ok": True}
+        await tg_send_message(chat_id, debug_text, reply_to_message_id=message_id)
+        return
 
     # Reset dev branch to default
     if cmd_base == "/reset":
-        dev_info = DEVELOPER_MAP.get(user_id)
-        if not dev_info:
-            tg_send_message(chat_id, "У тебя нет привязанной dev-ветки. Проверь DEVELOPER_MAP.", reply_to_message_id=message_id)
-            return {"ok": True}
-        branch = dev_info["branch"]
-        reset_repo = resolve_repo(chat_id, user_id)
+        target = await dev_command_target(chat_id, user_id, message_id)
+        if not target:
+            return
+        branch, reset_repo = target
         default_br = _default_branch(reset_repo)
         repo_tag = f" [{_repo_short(reset_repo)}]"
         keyboard = [
             [{"text": f"⚠️ Да, перезатереть {branch}", "callback_data": f"reset_confirm:{user_id}"}],
             [{"text": "Отмена", "callback_data": f"reset_cancel:{user_id}"}],
         ]
-        tg_send_message_with_keyboard(
+        await tg_send_message_with_keyboard(
             chat_id,
             f"Ты уверен?{repo_tag} Ветка `{branch}` будет полностью заменена на текущий `{default_br}`.\n\n"
             f"Все незамерженные изменения в `{branch}` будут потеряны!",
             keyboard,
             reply_to_message_id=message_id,
         )
-        return {"ok": True}
+        return
 
     # Clear stuck queue
     if cmd_base == "/clear":
-        dev_info = DEVELOPER_MAP.get(user_id)
-        if not dev_info:
-            tg_send_message(chat_id, "У тебя нет привязанной dev-ветки.", reply_to_message_id=message_id)
-            return {"ok": True}
-        branch = dev_info["branch"]
-        clear_repo = resolve_repo(chat_id, user_id)
+        target = await dev_command_target(chat_id, user_id, message_id)
+        if not target:
+            return
+        branch, clear_repo = target
         ctx = _ctx_key(clear_repo, branch)
-        queue_is_busy(clear_repo, branch)  # triggers recovery if needed
-        active = ACTIVE_TICKET.get(ctx)
-        pending_count = queue_size(clear_repo, branch)
+        # queue_active triggers recovery if needed
+        active, pending_count = await asyncio.gather(queue_active(clear_repo, branch), queue_size(clear_repo, branch))
 
         repo_tag = f" [{_repo_short(clear_repo)}]" 
         if not active and pending_count == 0:
-            tg_send_message(chat_id, f"Очередь{repo_tag} {branch} уже пуста, нечего очищать.", reply_to_message_id=message_id)
-            return {"ok": True}
+            await tg_send_message(chat_id, f"Очередь{repo_tag} {branch} уже пуста, нечего очищать.", reply_to_message_id=message_id)
+            return
 
         # Clear active ticket and stale deploy URL
-        queue_clear_active(clear_repo, branch)
+        await queue_clear_active(clear_repo, branch)
         LAST_DEPLOY_URL.pop(ctx, None)
 
         # Process queued tickets if any
         if pending_count > 0:
-            next_issue = queue_process_next(clear_repo, branch)
+            next_issue = await queue_process_next(clear_repo, branch)
             if next_issue:
-                tg_send_message(chat_id,
+                await tg_send_message(chat_id,
                     f"🧹 Очередь{repo_tag} {branch} очищена (был активен #{active['issue_number'] if active else '?'})\n"
                     f"▶️ Запущен следующий тикет из очереди",
                     reply_to_message_id=message_id)
             else:
-                tg_send_message(chat_id,
+                await tg_send_message(chat_id,
                     f"🧹 Очередь{repo_tag} {branch} очищена, но следующий тикет не удалось создать.",
                     reply_to_message_id=message_id)
         else:
-            tg_send_message(chat_id,
+            await tg_send_message(chat_id,
                 f"🧹 Активный тикет #{active['issue_number'] if active else '?'} снят с{repo_tag} {branch}. Очередь пуста.",
                 reply_to_message_id=message_id)
-        return {"ok": True}
+        return
 
     # Queue status (from GitHub Issues)
     if cmd_base == "/queue":
-        dev_info = DEVELOPER_MAP.get(user_id)
-        if not dev_info:
-            tg_send_message(chat_id, "У тебя нет привязанной dev-ветки.", reply_to_message_id=message_id)
-            return {"ok": True}
-        branch = dev_info["branch"]
-        q_repo = resolve_repo(chat_id, user_id)
+        if not await command_debounce(chat_id, user_id, cmd_base):
+            return
+        target = await dev_command_target(chat_id, user_id, message_id)
+        if not target:
+            return
+        branch, q_repo = target
         ctx = _ctx_key(q_repo, branch)
         repo_tag = f" [{_repo_short(q_repo)}]"
         # Check active (in-memory + GitHub fallback)
-        queue_is_busy(q_repo, branch)  # triggers recovery if needed
-        active = ACTIVE_TICKET.get(ctx)
-        pending = queue_list_pending(q_repo, branch)
+        active, pending = await asyncio.gather(queue_active(q_repo, branch), queue_list_pending(q_repo, branch))
 
         lines = [f"📋 Очередь для{repo_tag} {branch}\n"]
 
@@ -2033,23 +3247,22 @@ async def telegram_webhook(req: Request):
         else:
             lines.append("\n⏳ Очередь пуста")
 
-        tg_send_message(chat_id, "\n".join(lines), reply_to_message_id=message_id)
-        return {"ok": True}
+        await tg_send_message(chat_id, "\n".join(lines), reply_to_message_id=message_id)
+        return
 
     # Status command — full CI status overview
     if cmd_base == "/status":
-        dev_info = DEVELOPER_MAP.get(user_id)
-        if not dev_info:
-            tg_send_message(chat_id, "У тебя нет привязанной dev-ветки.", reply_to_message_id=message_id)
-            return {"ok": True}
-        branch = dev_info["branch"]
-        s_repo = resolve_repo(chat_id, user_id)
+        if not await command_debounce(chat_id, user_id, cmd_base):
+            return
+        target = await dev_command_target(chat_id, user_id, message_id)
+        if not target:
+            return
+        branch, s_repo = target
         ctx = _ctx_key(s_repo, branch)
         repo_tag = f" [{_repo_short(s_repo)}]"
-        queue_is_busy(s_repo, branch)  # triggers recovery from GitHub if needed after bot restart
-        active = ACTIVE_TICKET.get(ctx)
-        progress = CI_PROGRESS.get(ctx)
-        pending = queue_list_pending(s_repo, branch)
+        # queue_active triggers recovery from GitHub if needed after bot restart (and seeds CI progress)
+        active, pending = await asyncio.gather(queue_active(s_repo, branch), queue_list_pending(s_repo, branch))
+        progress = await state_get("ci", ctx)
         deploy_url = LAST_DEPLOY_URL.get(ctx)
 
         lines: List[str] = [f"📊 Статус{repo_tag} — {branch}\n"]
@@ -2058,29 +3271,17 @@ async def telegram_webhook(req: Request):
             lines.append(f"▶️ Тикет: #{active['issue_number']} — {active['title'][:60]}")
 
             if progress:
-                elapsed = now_ts() - progress["started_at"]
+                now = now_ts()
+                elapsed = now - progress["started_at"]
                 mins = elapsed // 60
                 secs = elapsed % 60
                 lines.append(f"⏱ Время: {mins}м {secs}с")
 
-                # Build workflow steps display
+                # Build workflow steps display (only steps applicable to the ticket's options)
                 opts = progress.get("options", {})
-                multi = opts.get("multi_agent") == "true"
-                testing = opts.get("testing") == "true"
-                approve = opts.get("approve") == "true"
-                # Define all possible workflow steps
-                all_steps = [
-                    ("1", "Планирование (Opus)", True),
-                    ("2", "Codex ревью", multi),
-                    ("A", "Апрув плана", approve),
-                    ("3", "Реализация (Opus)", True),
-                    ("4", "Codex код ревью", multi),
-                    ("5", "Тестирование", testing),
-                    ("6", "Финализация", True),
-                ]
-                # Filter to only applicable steps
-                steps = [(num, name) for num, name, enabled in all_steps if enabled]
-                phases_done = progress.get("phases_done", [])
+                steps = _STEPS_BY_OPTS[
+                    opts.get("multi_agent") == "true", opts.get("testing") == "true", opts.get("approve") == "true"]
+                phases_done = progress.get("phases_done") or {}
                 current_num = progress.get("current_phase_num", "")
 
                 if steps and (phases_done or current_num):
@@ -2095,7 +3296,7 @@ async def telegram_webhook(req: Request):
                 else:
                     lines.append(f"📍 Этап: {progress['last_phase']}")
 
-                since_update = now_ts() - progress["last_update_at"]
+                since_update = now - progress["last_update_at"]
                 if since_update > 300:
                     lines.append(f"\n⚠️ Последнее обновление: {since_update // 60}м назад")
 
@@ -2117,40 +3318,45 @@ async def telegram_webhook(req: Request):
         if deploy_url:
             lines.append(f"\n🔗 Последний билд: {deploy_url}")
 
-        tg_send_message(chat_id, "\n".join(lines), reply_to_message_id=message_id)
-        return {"ok": True}
+        await tg_send_message(chat_id, "\n".join(lines), reply_to_message_id=message_id)
+        return
 
-    # Approval feedback: user is typing plan corrections
-    if chat_id in APPROVAL_AWAITING_FEEDBACK and text and not text.startswith("/"):
-        fb = APPROVAL_AWAITING_FEEDBACK.pop(chat_id)
+    # Approval feedback: user is typing plan corrections. The draft read goes out in the same
+    # round trip — for plain group chatter these two reads are all the work done.
+    if text and not is_command:
+        fb, state = await asyncio.gather(state_pop("feedback", chat_id), pending_get(key))
+    else:
+        fb, state = None, await pending_get(key)
+    if fb:
         approval_key = fb["approval_key"]
         ci_issue = fb["issue_number"]
-        APPROVAL_REQUESTS[approval_key] = {"status": "revision", "feedback": text}
-        tg_send_message(chat_id,
+        await approval_set(approval_key, "revision", text)
+        await tg_send_message(chat_id,
             f"✏️ Поправки отправлены Claude — #{ci_issue}\n\n"
             f"Claude перепланирует с учётом твоих замечаний.",
             reply_to_message_id=message_id)
         print(f"[APPROVAL] {approval_key} → revision with feedback: {text[:100]}")
-        return {"ok": True}
+        return
 
     # If pending exists: allow edit and screenshot
-    if key in PENDING:
-        state = PENDING[key]
+    if state:
 
         # screenshot input (photo or image doc)
         img = extract_image_from_message(msg)
         if img:
             state["screenshot"] = {"file_id": img["file_id"], "ext": img["ext"]}
             state["stage"] = "confirm"
-            show_confirmation(chat_id, user_id, state, reply_to_message_id=message_id)
-            return {"ok": True}
+            await show_confirmation(chat_id, user_id, state, reply_to_message_id=message_id)
+            await pending_set(key, state)
+            return
 
         # text edit
         if state.get("stage") == "edit" and text:
             state["text"] = text
             state["stage"] = "confirm"
-            show_confirmation(chat_id, user_id, state, reply_to_message_id=message_id)
-            return {"ok": True}
+            await show_confirmation(chat_id, user_id, state, reply_to_message_id=message_id)
+            await pending_set(key, state)
+            return
 
     # Group gating: /ticket arms next voice
     if in_group and REQUIRE_TICKET_COMMAND:
@@ -2158,105 +3364,132 @@ async def telegram_webhook(req: Request):
         if is_cmd and rest:
             # Text ticket
             dev_info = DEVELOPER_MAP.get(user_id)
-            PENDING[key] = {
+            state = {
                 "stage": "confirm",
                 "text": rest,
                 "ts": now_ts(),
                 "screenshot": None,
                 "dev_info": dev_info,
-                "options": dict(DEFAULT_OPTIONS),
                 "repo": resolve_repo(chat_id, user_id),
             }
-            show_confirmation(chat_id, user_id, PENDING[key], reply_to_message_id=message_id)
-            return {"ok": True}
+            await show_confirmation(chat_id, user_id, state, reply_to_message_id=message_id)
+            await pending_set(key, state)
+            return
 
         if is_cmd and not rest:
-            ARMED[key] = now_ts() + ARM_TTL_SECONDS
-            tg_send_message(
+            await armed_set(key)
+            await tg_send_message(
                 chat_id,
                 f"Ок. Пришли голосовое в течение {ARM_TTL_SECONDS} сек — сделаю черновик тикета.",
                 reply_to_message_id=message_id,
             )
-            return {"ok": True}
+            return
 
         # ignore other texts in group
         if text and not msg.get("voice") and not msg.get("audio"):
-            return {"ok": True}
+            return
 
     # /ticket <text> in DM (outside group gating)
     if text and not in_group:
         is_cmd, rest = extract_ticket_command(text)
         if is_cmd and rest:
             dev_info = DEVELOPER_MAP.get(user_id)
-            PENDING[key] = {
+            state = {
                 "stage": "confirm",
                 "text": rest,
                 "ts": now_ts(),
                 "screenshot": None,
                 "dev_info": dev_info,
-                "options": dict(DEFAULT_OPTIONS),
                 "repo": resolve_repo(chat_id, user_id),
             }
-            show_confirmation(chat_id, user_id, PENDING[key], reply_to_message_id=message_id)
-            return {"ok": True}
+            await show_confirmation(chat_id, user_id, state, reply_to_message_id=message_id)
+            await pending_set(key, state)
+            return
 
     # Plain text outside group gating
     if text and not msg.get("voice") and not msg.get("audio"):
-        tg_send_message(chat_id, "Пришли голосовое (или /ticket <текст>). Скриншот можно отправить после распознавания.", reply_to_message_id=message_id)
-        return {"ok": True}
+        await tg_send_message(chat_id, "Пришли голосовое (или /ticket <текст>). Скриншот можно отправить после распознавания.", reply_to_message_id=message_id)
+        return
 
     # Voice/audio handling
     file_obj = msg.get("voice") or msg.get("audio")
     if not file_obj:
-        return {"ok": True}
+        return
 
     # If in group and require command: accept only if armed
     if in_group and REQUIRE_TICKET_COMMAND:
-        expires = ARMED.get(key, 0)
-        if expires < now_ts():
-            return {"ok": True}
-
-    tg_send_message(chat_id, "Распознаю голос…", reply_to_message_id=message_id)
+        if not await armed_check(key):
+            return
 
-    try:
-        file_path = tg_get_file_path(file_obj["file_id"])
-        if not file_path:
-            tg_send_message(chat_id, "Не смог получить файл из Telegram (getFile).", reply_to_message_id=message_id)
-            return {"ok": True}
+    if (file_obj.get("file_size") or 0) > MAX_AUDIO_BYTES:
+        await tg_send_message(chat_id, "Файл слишком большой (максимум 20 МБ).", reply_to_message_id=message_id)
+        return
 
-        with tempfile.TemporaryDirectory() as tmp:
-            src = os.path.join(tmp, "input")
-            mp3 = os.path.join(tmp, "audio.mp3")
-            tg_download_file(file_path, src)
+    # The "recognizing" notice goes out while the file is fetched; it is awaited
+    # before any follow-up message so the chat order stays the same.
+    notice = asyncio.create_task(tg_send_message(chat_id, "Распознаю голос…", reply_to_message_id=message_id))
 
-            try:
-                ffmpeg_to_mp3(src, mp3)
-                audio_path = mp3
-            except Exception:
-                audio_path = src
+    try:
+        unique_key = f"fu:{file_obj['file_unique_id']}" if file_obj.get("file_unique_id") else None
+        recognized = await transcript_cache_get(unique_key) if unique_key else None
+
+        if recognized is None:
+            fetched = await tg_fetch_file(file_obj["file_id"])
+            if not fetched:
+                await asyncio.gather(notice, return_exceptions=True)
+                await tg_send_message(chat_id, "Не смог получить файл из Telegram (getFile).", reply_to_message_id=message_id)
+                return
+
+            file_path, raw = fetched
+            content_key = f"tx:{audio_digest(raw)}"
+            recognized = await transcript_cache_get(content_key)
+            if recognized is None:
+                filename = audio_upload_name(
+                    file_path,
+                    is_voice=bool(msg.get("voice")),
+                    mime_type=file_obj.get("mime_type") or "",
+                )
+                audio = raw
+                if filename is None:
+                    try:
+                        audio, filename = await transcode_to_mp3(raw), "audio.mp3"
+                    except Exception as e:
+                        print(f"[VOICE] Transcode failed, sending original: {e}")
+                        filename = "audio.ogg"
+
+                recognized = await transcribe(audio, filename)
+                if recognized:
+                    await transcript_cache_set(content_key, recognized)
+            else:
+                print(f"[VOICE] Transcript cache hit ({content_key})")
 
-            recognized = transcribe(audio_path)
+            if recognized and unique_key:
+                await transcript_cache_set(unique_key, recognized)
+        else:
+            print(f"[VOICE] Transcript cache hit ({unique_key})")
 
+        await asyncio.gather(notice, return_exceptions=True)
         if not recognized:
-            tg_send_message(chat_id, "Не смог распознать 😕", reply_to_message_id=message_id)
-            return {"ok": True}
+            await tg_send_message(chat_id, "Не смог распознать 😕", reply_to_message_id=message_id)
+            return
 
         # consume arm
-        ARMED.pop(key, None)
+        await armed_pop(key)
 
         dev_info = DEVELOPER_MAP.get(user_id)
-        PENDING[key] = {
+        state = {
             "stage": "confirm",
             "text": recognized,
             "ts": now_ts(),
             "screenshot": None,
             "dev_info": dev_info,
-            "options": dict(DEFAULT_OPTIONS),
             "repo": resolve_repo(chat_id, user_id),
         }
-        show_confirmation(chat_id, user_id, PENDING[key], reply_to_message_id=message_id)
-        return {"ok": True}
+        await show_confirmation(chat_id, user_id, state, reply_to_message_id=message_id)
+        await pending_set(key, state)
+        return
 
     except Exception as e:
-        tg_send_message(chat_id, f"Ошибка: {type(e).__name__}\n{e}", reply_to_message_id=message_id)
-        return {"ok": True}
+        await asyncio.gather(notice, return_exceptions=True)
+        await tg_send_message(chat_id, f"Ошибка: {type(e).__name__}\n{e}", reply_to_message_id=message_id)
+        return